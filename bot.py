@@ -1,22 +1,64 @@
+import time
+_MODULE_STARTED = time.perf_counter()
+
 import os
+import sys
+import signal
+import random
+import hashlib
 import asyncio
 import logging
-from datetime import datetime
-from typing import List, Dict, Optional
+import functools
+import contextlib
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, List, Dict, Optional
 
-import aiohttp
-from bs4 import BeautifulSoup
-from telegram import Bot
+# aiohttp, bs4, telegram и sqlite3 импортируются при первом использовании:
+# запуск, которому нечего публиковать, не платит за загрузку Telegram-клиента
 import re
 import json
+import math
+import mmap
+import struct
 from pathlib import Path    
+from urllib.parse import urlparse
+
+from telegram_sender import TelegramSender
+
+if TYPE_CHECKING:
+    import aiohttp
+
 
 
 
 
+# Запись/воспроизведение HTTP (HTTP_FIXTURES=record|replay): без сети (replay), без Telegram и со своим состоянием.
+# Другое значение — опечатка: режим не включается (предупреждение — в fixtures_entry)
+HTTP_FIXTURES_MODES = ("record", "replay")
+HTTP_FIXTURES = os.getenv("HTTP_FIXTURES", "").lower()
+if HTTP_FIXTURES not in HTTP_FIXTURES_MODES:
+    HTTP_FIXTURES = ""
+HTTP_FIXTURES_DIR = Path(os.getenv("HTTP_FIXTURES_DIR", "fixtures/http"))
 
-STATE_DIR = Path("state")
+STATE_DIR = Path(os.getenv("STATE_DIR", "state"))
 POSTED_FILE = STATE_DIR / "load_posted.json"
+POSTED_JOURNAL = STATE_DIR / "posted_journal.jsonl"
+IMAGE_HASHES_FILE = STATE_DIR / "image_hashes.json"
+DIGEST_MARKER_FILE = STATE_DIR / "digest_sent.json"
+STATE_DB = STATE_DIR / "events.db"
+# Кэши между запусками (в git не коммитятся, в Actions сохраняются через actions/cache)
+CACHE_DIR = STATE_DIR / "cache"
+HTTP_CACHE_DIR = CACHE_DIR / "http"
+# Фильтр собирается из снапшота и журнала, поэтому это кэш: устаревший файл узнаётся по заголовку и пересобирается
+POSTED_BLOOM = CACHE_DIR / "load_posted.bloom"
+FINGERPRINTS_FILE = CACHE_DIR / "fingerprints.json"
+SOURCE_HEALTH_FILE = CACHE_DIR / "source_health.json"
+SCHEDULE_FILE = CACHE_DIR / "schedule.json"
+DETAILS_CACHE_FILE = CACHE_DIR / "details.json"
+REJECTED_FILE = CACHE_DIR / "rejected.json"
+UPCOMING_FILE = CACHE_DIR / "upcoming.json"
+FILE_IDS_FILE = CACHE_DIR / "file_ids.json"
+CROPS_FILE = CACHE_DIR / "crops.json"
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,6 +67,116 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID", "-1003812789640")
 MESSAGE_THREAD_ID = int(os.getenv("MESSAGE_THREAD_ID", "4"))
 
+# Параллельный обход источников: общий лимит и лимит на один хост (1 = последовательно)
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+CRAWL_PER_HOST = int(os.getenv("CRAWL_PER_HOST", "2"))
+# С одного сайта за запуск — не больше стольких ещё не опубликованных событий
+SITE_EVENTS_MAX = 5
+
+# После стольких записей журнал сворачивается в снапшот load_posted.json
+POSTED_JOURNAL_MAX = int(os.getenv("POSTED_JOURNAL_MAX", "200"))
+# Ссылки без даты ивента (старый формат load_posted.json) забываются через столько дней после загрузки
+POSTED_UNDATED_TTL_DAYS = int(os.getenv("POSTED_UNDATED_TTL_DAYS", "30"))
+# Bloom-фильтр перед posted: ёмкость до пересборки и доля ложных срабатываний
+BLOOM_CAPACITY = int(os.getenv("BLOOM_CAPACITY", "10000"))
+BLOOM_ERROR_RATE = float(os.getenv("BLOOM_ERROR_RATE", "0.01"))
+# Хранилище состояния: json (снапшот + журнал) или sqlite (state/events.db)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json").lower()
+
+# HTTP-кэш с условными запросами: лимит по размеру и по возрасту записей
+HTTP_CACHE_MAX_MB = float(os.getenv("HTTP_CACHE_MAX_MB", "20"))
+HTTP_CACHE_MAX_AGE_DAYS = float(os.getenv("HTTP_CACHE_MAX_AGE_DAYS", "7"))
+
+# Пул соединений, общий для страниц, деталей ивентов и загрузки фото
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "30"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "6"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "15"))
+
+# Адаптивное расписание: интервал обхода источника подстраивается под частоту его изменений.
+# В URLS / TELEGRAM_CHANNELS можно задать "interval" (минуты) или "always": True вручную.
+ADAPTIVE_SCHEDULE = os.getenv("ADAPTIVE_SCHEDULE", "1") == "1"
+SCHEDULE_MIN_INTERVAL = float(os.getenv("SCHEDULE_MIN_INTERVAL_MIN", "5")) * 60
+SCHEDULE_MAX_INTERVAL = float(os.getenv("SCHEDULE_MAX_INTERVAL_MIN", "720")) * 60
+SCHEDULE_MAX_PER_RUN = int(os.getenv("SCHEDULE_MAX_PER_RUN", "12"))
+
+# Режим демона (python bot.py --daemon): период цикла и случайный разброс старта
+DAEMON_INTERVAL_MIN = float(os.getenv("DAEMON_INTERVAL_MIN", "5"))
+DAEMON_JITTER_SEC = float(os.getenv("DAEMON_JITTER_SEC", "30"))
+
+# Сколько кандидатов готовить (детали + обложка) впереди отправки
+PREFETCH_QUEUE = int(os.getenv("PREFETCH_QUEUE", "4"))
+
+# Кэш результатов fetch_event_details (описание + og:image) по нормализованной ссылке
+DETAILS_TTL_HOURS = float(os.getenv("DETAILS_TTL_HOURS", "24"))
+DETAILS_CACHE_MAX = int(os.getenv("DETAILS_CACHE_MAX", "500"))
+
+# file_id загруженных обложек: повторная картинка уходит ссылкой на уже загруженный файл
+FILE_ID_TTL_DAYS = float(os.getenv("FILE_ID_TTL_DAYS", "30"))
+FILE_ID_CACHE_MAX = int(os.getenv("FILE_ID_CACHE_MAX", "1000"))
+
+# Обложки ужимаются до размера, который Telegram всё равно показывает (длинная сторона), и в прогрессивный JPEG
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+
+# Проба обложки: размеры и формат по первым байтам (Range), до полной загрузки
+IMAGE_PROBE_BYTES = int(os.getenv("IMAGE_PROBE_BYTES", "65536"))
+IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", "200"))
+IMAGE_ICON_SIDE = int(os.getenv("IMAGE_ICON_SIDE", "400"))
+# Отказываем только иконкам: всё, что читает Pillow, перед загрузкой перекодируется в JPEG,
+# а как есть уходят лишь анимации (GIF/WEBP/PNG), которые Telegram принимает
+IMAGE_REJECT_FORMATS = {"ICO", "CUR"}
+# MPO — JPEG с телефонов с несколькими кадрами (превью, стерео); первый кадр — обычный JPEG
+JPEG_FORMATS = ("JPEG", "MPO")
+
+# Один и тот же постер под разными ссылками: dHash обложки и порог по расстоянию Хэмминга (из 64 бит)
+PHASH_DISTANCE = int(os.getenv("PHASH_DISTANCE", "6"))
+PHASH_TTL_DAYS = float(os.getenv("PHASH_TTL_DAYS", "30"))
+
+# Умная обрезка афиш: срезаем полосы с датой сверху/снизу (дата и так есть в тексте поста).
+# Полосы текста ищутся по плотности контуров, OCR (pytesseract) читает только спорные полосы
+SMART_CROP = os.getenv("SMART_CROP", "0") == "1"
+SMART_CROP_WORKERS = int(os.getenv("SMART_CROP_WORKERS", "2"))
+SMART_CROP_CACHE_MAX = int(os.getenv("SMART_CROP_CACHE_MAX", "1000"))
+CROP_MARGIN = 30
+
+# Отклонённые кандидаты не проверяются заново, пока не изменятся, не пройдёт дата или этот срок
+REJECT_TTL_DAYS = float(os.getenv("REJECT_TTL_DAYS", "3"))
+
+# Альбомы: до ALBUM_SIZE ивентов одного запуска уходят одним send_media_group (Telegram допускает 2–10)
+ALBUM_MODE = os.getenv("ALBUM_MODE", "0") == "1"
+ALBUM_SIZE = max(2, min(10, int(os.getenv("ALBUM_SIZE", "10"))))
+
+# Дайджест (python bot.py --digest): ивенты на DIGEST_DAYS вперёд одним сообщением (или несколькими по лимиту)
+DIGEST_DAYS = int(os.getenv("DIGEST_DAYS", "7"))
+DIGEST_PIN = os.getenv("DIGEST_PIN", "0") == "1"
+# Ежедневный дайджест из обычного запуска: первый запуск после этого часа (UTC) отправляет его, если сегодня ещё не было.
+# Пусто — только по --digest
+DIGEST_HOUR_UTC = int(os.getenv("DIGEST_HOUR_UTC")) if os.getenv("DIGEST_HOUR_UTC") else None
+TG_MESSAGE_LIMIT = 4096
+
+# Повторы с экспоненциальной задержкой и предохранитель для падающих хостов
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "2"))
+FETCH_BACKOFF = float(os.getenv("FETCH_BACKOFF", "0.5"))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN_MIN", "30")) * 60
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN_MIN", "360")) * 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+@functools.lru_cache(maxsize=None)
+def accept_encoding() -> str:
+    # aiohttp распаковывает br только при установленном brotli — иначе не просим его у сервера
+    for module in ("brotli", "brotlicffi"):
+        try:
+            __import__(module)
+            return "gzip, deflate, br"
+        except ImportError:
+            continue
+    return "gzip, deflate"
+
 def strip_intro_phrases(text: str) -> str:
     patterns = [
         r"^в\s+(понедельник|вторник|среду|четверг|пятницу|субботу|воскресенье)\s+",
@@ -39,14 +191,24 @@ def strip_intro_phrases(text: str) -> str:
         s = re.sub(p, "", s, flags=re.IGNORECASE)
     return s.strip(" -–•,")
 
-def remove_city_from_title(title: str) -> str:
-    # Проходим по всем городам из словаря
+@functools.lru_cache(maxsize=None)
+def city_patterns() -> List[tuple]:
+    # Пары регулярок на каждый город (144 города — 288 шаблонов) компилируются один раз,
+    # а не ищутся заново в кэше re для каждого заголовка
     emoji_pattern = r"[\U00010000-\U0010ffff\u2600-\u27ff\u2300-\u23ff\u25a0-\u25ff\u2B00-\u2BFF]"
-    for city_key in KZ_CITIES.keys():
+    return [
         # Регулярка ищет город в начале строки или как отдельное слово, игнорируя регистр
         # (?:{emoji_pattern}|\W)* позволяет найти город сразу после эмодзи в начале
-        title = re.sub(rf"^(?:{emoji_pattern}|\W)*{city_key}\b", "", title, flags=re.IGNORECASE)
-        title = re.sub(rf"\b{city_key}\b", "", title, flags=re.IGNORECASE)
+        (re.compile(rf"^(?:{emoji_pattern}|\W)*{city_key}\b", re.IGNORECASE),
+         re.compile(rf"\b{city_key}\b", re.IGNORECASE))
+        for city_key in KZ_CITIES.keys()
+    ]
+
+def remove_city_from_title(title: str) -> str:
+    # Проходим по всем городам из словаря
+    for leading_re, word_re in city_patterns():
+        title = leading_re.sub("", title)
+        title = word_re.sub("", title)
         
     # Чистим двойные пробелы и висячие знаки препинания, которые остались после удаления
     title = re.sub(r"\s{2,}", " ", title)
@@ -182,25 +344,393 @@ def normalize_link(link: str) -> str:
     link = link.rstrip("/")
     return link
 
-def load_posted() -> set:
-    if POSTED_FILE.exists():
+class BloomFilter:
+    """Bloom-фильтр по load_posted.json в state/cache; читается через mmap, без разбора JSON."""
+
+    HEADER = struct.Struct("<4sIIIQQ")  # magic, биты, хэши, элементов, размер снапшота, размер журнала
+    MAGIC = b"BLM1"
+
+    def __init__(self, mm: mmap.mmap):
+        self.mm = mm
+        _, self.m, self.k, self.count, self.snapshot_size, self.journal_size = self.HEADER.unpack_from(mm, 0)
+
+    @classmethod
+    def open(cls, path: Path) -> Optional["BloomFilter"]:
         try:
-            with open(POSTED_FILE, "r", encoding="utf-8") as f:
-                return set(json.load(f))
-        except Exception:
-            return set()
-    return set()
+            with open(path, "r+b") as f:
+                mm = mmap.mmap(f.fileno(), 0)
+        except (OSError, ValueError):
+            return None
+        if len(mm) < cls.HEADER.size or mm[:4] != cls.MAGIC:
+            mm.close()
+            return None
+        bloom = cls(mm)
+        if len(mm) != cls.HEADER.size + (bloom.m + 7) // 8:
+            mm.close()
+            return None
+        return bloom
+
+    @classmethod
+    def create(cls, path: Path, items, capacity: int) -> Optional["BloomFilter"]:
+        items = list(items)
+        n = max(capacity, 2 * len(items), 1)
+        m = math.ceil(-n * math.log(BLOOM_ERROR_RATE) / math.log(2) ** 2)
+        k = max(1, round(m / n * math.log(2)))
+        buf = bytearray(cls.HEADER.size + (m + 7) // 8)
+        cls.HEADER.pack_into(buf, 0, cls.MAGIC, m, k, len(items), 0, 0)
+        for item in items:
+            for pos in cls._positions(item, m, k):
+                buf[cls.HEADER.size + (pos >> 3)] |= 1 << (pos & 7)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(path.suffix + ".tmp")
+            tmp.write_bytes(buf)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"Ошибка записи {path}: {e}")
+            return None
+        return cls.open(path)
+
+    @staticmethod
+    def _positions(key: str, m: int, k: int):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % m for i in range(k)]
+
+    def __contains__(self, key: str) -> bool:
+        base = self.HEADER.size
+        return all(self.mm[base + (pos >> 3)] & (1 << (pos & 7)) for pos in self._positions(key, self.m, self.k))
+
+    def add(self, key: str):
+        base = self.HEADER.size
+        for pos in self._positions(key, self.m, self.k):
+            self.mm[base + (pos >> 3)] |= 1 << (pos & 7)
+        self.count += 1
+
+    def sync(self, snapshot_size: int, journal_size: int):
+        # Размеры файлов состояния в заголовке: если они разойдутся (ручная правка, git merge), фильтр пересоберётся
+        self.snapshot_size, self.journal_size = snapshot_size, journal_size
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.m, self.k, self.count, snapshot_size, journal_size)
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def undated_expiry() -> str:
+    # Ссылке без даты ивента вместо даты ставится срок хранения: дальше она чистится как прошедший ивент
+    return datetime.fromordinal(datetime.now().toordinal() + POSTED_UNDATED_TTL_DAYS).date().isoformat()
+
+class PostedStore:
+    """Опубликованные ссылки с датой ивента: снапшот load_posted.json + журнал, куда каждый пост дописывается одной строкой.
+    У ссылок без даты вместо неё — срок хранения (undated_expiry).
+
+    Перед точным множеством стоит Bloom-фильтр: отрицательные проверки не требуют загружать историю.
+    """
+
+    def __init__(self, snapshot: Path = POSTED_FILE, journal: Path = POSTED_JOURNAL, bloom: Path = POSTED_BLOOM):
+        self.snapshot = snapshot
+        self.journal = journal
+        self.bloom_path = bloom
+        self._links = None
+        self.journal_records = self._check_journal()
+
+        self.bloom = BloomFilter.open(bloom)
+        if self.bloom and (self.bloom.snapshot_size, self.bloom.journal_size) != (_file_size(snapshot), _file_size(journal)):
+            self.bloom.close()
+            self.bloom = None
+        if self.bloom is None:
+            self._rebuild_bloom()
+
+    def _check_journal(self) -> int:
+        if not self.journal.exists():
+            return 0
+        try:
+            data = self.journal.read_bytes()
+            # Оборванная при падении последняя строка отрезается, иначе следующая запись склеится с ней
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                with open(self.journal, "r+b") as f:
+                    f.truncate(end)
+            return data.count(b"\n")
+        except OSError as e:
+            logger.error(f"Ошибка чтения журнала {self.journal}: {e}")
+            return 0
+
+    @property
+    def links(self) -> Dict[str, Optional[str]]:
+        if self._links is None:
+            self._load()
+        return self._links
+
+    def _load(self):
+        data = load_json(self.snapshot, {})
+        # Старый формат снапшота — просто список ссылок, без дат
+        self._links = dict.fromkeys(data) if isinstance(data, list) else dict(data)
+        stamped = False
+        try:
+            lines = self.journal.read_bytes().splitlines() if self.journal.exists() else []
+        except OSError as e:
+            logger.error(f"Ошибка чтения журнала {self.journal}: {e}")
+            lines = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+                self._links[record["link"]] = record.get("event_date")
+            except (ValueError, KeyError):
+                continue
+        expiry = undated_expiry()
+        for link, event_date in self._links.items():
+            if not event_date:
+                self._links[link] = expiry
+                stamped = True
+        # Проставленный срок сразу уходит в снапшот, иначе он сдвигался бы с каждой загрузкой
+        if self.prune() or stamped:
+            self.compact()
+
+    def _rebuild_bloom(self):
+        items = self.links
+        if self.bloom:
+            self.bloom.close()
+        self.bloom = BloomFilter.create(self.bloom_path, items, BLOOM_CAPACITY)
+        if self.bloom:
+            self.bloom.sync(_file_size(self.snapshot), _file_size(self.journal))
+
+    def prune(self) -> int:
+        # Прошедшие ивенты всё равно отсекает is_future, помнить их ссылки незачем; ссылки без даты — по сроку хранения
+        today = datetime.now().date().isoformat()
+        expired = [link for link, event_date in self.links.items() if event_date and event_date < today]
+        for link in expired:
+            del self._links[link]
+        if expired:
+            logger.info(f"🧹 Удалено прошедших ивентов из posted: {len(expired)}")
+        return len(expired)
+
+    def __contains__(self, link: str) -> bool:
+        if self.bloom is not None and link not in self.bloom:
+            return False
+        return link in self.links
+
+    def __len__(self) -> int:
+        if self._links is None and self.bloom is not None:
+            return self.bloom.count
+        return len(self.links)
+
+    def __iter__(self):
+        return iter(self.links)
+
+    def add(self, link: str, event_date: Optional[str] = None, title: str = ""):
+        # title хранит только SqliteState; здесь он принимается ради общего интерфейса
+        if link in self:
+            return
+        # Бит в фильтре ставится до записи в журнал: при падении между ними будет лишь ложное «уже было»
+        if self.bloom is not None:
+            self.bloom.add(link)
+        event_date = event_date or undated_expiry()
+        if self._links is not None:
+            self._links[link] = event_date
+        record = {"link": link, "ts": int(time.time()), "event_date": event_date}
+        try:
+            self.journal.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.journal, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.error(f"Ошибка записи журнала {self.journal}: {e}")
+            return
+        if self.bloom is not None:
+            self.bloom.sync(_file_size(self.snapshot), _file_size(self.journal))
+        self.journal_records += 1
+        if self.journal_records >= POSTED_JOURNAL_MAX:
+            self.compact()
+
+    def compact(self):
+        # Сначала атомарно пишем снапшот, потом чистим журнал: падение между шагами лишь повторит записи
+        self.prune()
+        if not save_posted(self.links):
+            return
+        try:
+            with open(self.journal, "w", encoding="utf-8"):
+                pass
+            self.journal_records = 0
+        except OSError as e:
+            logger.error(f"Ошибка очистки журнала {self.journal}: {e}")
+        # Из Bloom-фильтра удалять нельзя — после чистки прошедших он собирается заново
+        self._rebuild_bloom()
+
+class SqliteState:
+    """Состояние в SQLite: события, публикации, источники и вердикты; проверки — по индексам, а не по set в памяти."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            link TEXT PRIMARY KEY, title TEXT, title_key TEXT, event_date TEXT,
+            city TEXT, source TEXT, first_seen INTEGER, last_seen INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS events_event_date ON events(event_date);
+        CREATE INDEX IF NOT EXISTS events_title_key ON events(title_key);
+        CREATE TABLE IF NOT EXISTS posts (
+            link TEXT PRIMARY KEY, title_key TEXT, event_date TEXT, posted_at INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS posts_event_date ON posts(event_date);
+        CREATE INDEX IF NOT EXISTS posts_title_key ON posts(title_key);
+        CREATE TABLE IF NOT EXISTS sources (
+            key TEXT PRIMARY KEY, name TEXT, last_crawl INTEGER, events INTEGER, seconds REAL
+        );
+        CREATE TABLE IF NOT EXISTS verdicts (
+            link TEXT PRIMARY KEY, hash TEXT, reason TEXT, expires TEXT
+        );
+        CREATE INDEX IF NOT EXISTS verdicts_expires ON verdicts(expires);
+    """
+
+    def __init__(self, path: Path = STATE_DB):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        import sqlite3
+        self.conn = sqlite3.connect(str(path))
+        with self.conn:
+            self.conn.executescript(self.SCHEMA)
+        self._import_json()
+        self.sweep()
+
+    def _import_json(self):
+        # Первый запуск на SQLite: переносим историю из load_posted.json, чтобы ничего не опубликовать повторно
+        if self.conn.execute("SELECT 1 FROM posts LIMIT 1").fetchone():
+            return
+        legacy = PostedStore()
+        if len(legacy):
+            now = int(time.time())
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO posts (link, event_date, posted_at) VALUES (?, ?, ?)",
+                    [(link, event_date, now) for link, event_date in legacy.links.items()],
+                )
+            logger.info(f"🗃️ Перенесено в SQLite публикаций: {len(legacy)}")
+
+    def sweep(self):
+        # Прошедшие события больше не пройдут is_future — их строки не нужны
+        today = datetime.now().date().isoformat()
+        with self.conn:
+            # Публикациям без даты (перенесённым из старого формата) — срок хранения, как в PostedStore
+            self.conn.execute("UPDATE posts SET event_date = ? WHERE event_date IS NULL", (undated_expiry(),))
+            self.conn.execute("DELETE FROM events WHERE event_date < ?", (today,))
+            self.conn.execute("DELETE FROM posts WHERE event_date < ?", (today,))
+            self.conn.execute("DELETE FROM verdicts WHERE expires <= ?", (today,))
+
+    # Интерфейс PostedStore
+    def __contains__(self, link: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM posts WHERE link = ?", (link,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+    def __iter__(self):
+        return (row[0] for row in self.conn.execute("SELECT link FROM posts"))
+
+    def add(self, link: str, event_date: Optional[str] = None, title: str = ""):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO posts (link, title_key, event_date, posted_at) VALUES (?, ?, ?, ?)",
+                (link, title[:60].lower() or None, event_date or undated_expiry(), int(time.time())),
+            )
+
+    def compact(self):
+        self.sweep()
+
+    # События и источники
+    def record_events(self, events: List[Dict]):
+        now = int(time.time())
+        rows = [
+            (normalize_link(e.get("link", "")), e.get("title", ""), (e.get("title", "")[:60]).lower(),
+             e.get("event_date"), e.get("location") or None, e.get("source"), now, now)
+            for e in events if e.get("link")
+        ]
+        with self.conn:
+            self.conn.executemany(
+                """INSERT INTO events (link, title, title_key, event_date, city, source, first_seen, last_seen)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(link) DO UPDATE SET title = excluded.title, title_key = excluded.title_key,
+                       event_date = excluded.event_date, city = excluded.city, last_seen = excluded.last_seen""",
+                rows,
+            )
 
-def save_posted(posted: set):
+    def record_source(self, key: str, name: str, events: int, seconds: float):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sources (key, name, last_crawl, events, seconds) VALUES (?, ?, ?, ?, ?)",
+                (key, name, int(time.time()), events, seconds),
+            )
+
+    # Вердикты (интерфейс RejectionIndex)
+    def is_rejected(self, link: str, digest: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM verdicts WHERE link = ? AND hash = ? AND expires > ?",
+            (link, digest, datetime.now().date().isoformat()),
+        ).fetchone()
+        return row is not None
+
+    def add_verdict(self, link: str, digest: str, reason: str, expires: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO verdicts (link, hash, reason, expires) VALUES (?, ?, ?, ?)",
+                (link, digest, reason, expires),
+            )
+
+    def close(self):
+        self.conn.close()
+
+def load_posted():
+    if STATE_BACKEND == "sqlite":
+        return SqliteState()
+    return PostedStore()
+
+def save_posted(posted: Dict[str, Optional[str]]) -> bool:
     try:
         STATE_DIR.mkdir(parents=True, exist_ok=True)
-        with open(POSTED_FILE, "w", encoding="utf-8") as f:
-            json.dump(list(posted), f, ensure_ascii=False, indent=2)
+        tmp = POSTED_FILE.with_suffix(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(dict(sorted(posted.items())), f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, POSTED_FILE)
+        return True
     except Exception as e:
         logger.error(f"Ошибка сохранения posted_links: {e}")
+        return False
+
+def make_soup(html: str):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, "html.parser")
+
+def load_json(path: Path, default):
+    if path.exists():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return default
+    return default
+
+def save_json(path: Path, data):
+    # Пишем во временный файл и атомарно подменяем, чтобы прерванный запуск не оставил битый JSON
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения {path}: {e}")
 
 URLS = [
-    {"url": "https://astanahub.com/ru/event/", "name": "Astana Hub"},
+    {"url": "https://astanahub.com/ru/event/", "name": "Astana Hub", "interval": 5},
     {"url": "https://er10.kz", "name": "ER10"},
     {"url": "https://kapital.kz", "name": "Capital"},
     {"url": "https://forbes.kz", "name": "Forbes kz"},
@@ -522,15 +1052,17 @@ def clean_title_deterministic(raw_title: str) -> Optional[str]:
     if len(s) < 5 or looks_like_description(s): return None
     return s[:120]
 
-city_pattern = "|".join([re.escape(v) for v in KZ_CITIES.values()])
-_GLUE_RE = re.compile(
-    rf"^(\d{{1,2}})\s+([А-ЯЁа-яёA-Za-z]{{3,}})[,\s]+(\d{{1,2}}:\d{{2}})\s*(?:(Онлайн|online|zoom|{city_pattern})\s*)?(.+)$",
-    re.IGNORECASE
-)
+@functools.lru_cache(maxsize=None)
+def glue_re() -> re.Pattern:
+    city_pattern = "|".join([re.escape(v) for v in KZ_CITIES.values()])
+    return re.compile(
+        rf"^(\d{{1,2}})\s+([А-ЯЁа-яёA-Za-z]{{3,}})[,\s]+(\d{{1,2}}:\d{{2}})\s*(?:(Онлайн|online|zoom|{city_pattern})\s*)?(.+)$",
+        re.IGNORECASE
+    )
 
 def parse_glued_line(line: str) -> Optional[Dict]:
     line = normalize_glued_text(line)
-    m = _GLUE_RE.match(line)
+    m = glue_re().match(line)
     if not m: return None
 
     day_s, month_s, time_str = m.group(1), m.group(2).lower(), m.group(3)
@@ -563,8 +1095,8 @@ def remove_city_and_hub_from_text(text: str) -> str:
     text = re.sub(r'\bв\s+[A-Za-zА-Яа-яЁё-]+\s+Hub\b', '', text, flags=re.IGNORECASE)
 
     # Удаляем все города из словаря KZ_CITIES
-    for city_key in KZ_CITIES.keys():
-        text = re.sub(rf'\b{city_key}\b', '', text, flags=re.IGNORECASE)
+    for _, word_re in city_patterns():
+        text = word_re.sub('', text)
 
     # Чистим двойные пробелы
     text = re.sub(r'\s{2,}', ' ', text)
@@ -574,13 +1106,19 @@ def remove_city_and_hub_from_text(text: str) -> str:
 
     return text.strip()
 # ─── Formatting post ───────────────────────────────────────
+def reject(event: Dict, reason: str) -> str:
+    # Причина отказа нужна main(), чтобы не проверять этот ивент снова в следующих запусках
+    event["reject_reason"] = reason
+    return ""
+
 def make_post(event: Dict) -> str:
+    event.pop("reject_reason", None)
     title = (event.get("title") or "").strip()
     date_str = (event.get("date") or "").strip()
     link = (event.get("link") or "").strip()
 
     if not title or len(title) < 5 or not date_str or not link:
-        return ""
+        return reject(event, "incomplete")
 
     location = event.get("location", "")
     venue = event.get("venue", "")
@@ -661,19 +1199,19 @@ def make_post(event: Dict) -> str:
     # (Здесь location будет либо пустой (Казахстан), либо один из КЗ городов, 
     # либо "Онлайн". Если это Ташкент или Бишкек, выкидываем пост на этапе сборки)
     if location and not is_online and "Узбекистан" in location or "Кыргызстан" in location or "Словения" in location or "Slovenia" in location:
-        return ""
+        return reject(event, "location")
 
     # 🔥 ФИЛЬТР ПО ЯЗЫКУ: Если в тексте нет русского языка (кириллицы), отбрасываем
     # Проверяем сам заголовок на наличие русского текста
     cyrillic_in_title = len(re.findall(r'[а-яА-ЯёЁ]', title))
     if cyrillic_in_title < 2:  # Если в заголовке нет хотя бы 2 русских букв, скорее всего он на английском
-        return ""
+        return reject(event, "language")
 
     # Считаем количество кириллических символов во всем тексте (заголовок + описание)
     full_text_for_lang_check = f"{title} {description}"
     cyrillic_chars = len(re.findall(r'[а-яА-ЯёЁ]', full_text_for_lang_check))
     if cyrillic_chars < 15: # Если меньше 15 русских букв на весь пост - скорее всего это чистый английский или мусор
-        return ""
+        return reject(event, "language")
 
     # 🔥 ФИЛЬТР ПО ТЕМАТИКЕ: Только ивенты про стартапы и предпринимательство
     # Проверяем заголовок + описание + полный текст на наличие ключевых слов
@@ -719,11 +1257,11 @@ def make_post(event: Dict) -> str:
     
     # Если есть стоп-слово и нет стартап-ключевого — отбрасываем
     if has_stop_keyword and not has_startup_keyword:
-        return ""
+        return reject(event, "topic")
     
     # Если вообще нет ни одного стартап-ключевого слова — тоже отбрасываем
     if not has_startup_keyword:
-        return ""
+        return reject(event, "topic")
 
     if is_online:
         lines.append("🌐 Онлайн")
@@ -753,40 +1291,1012 @@ def make_post(event: Dict) -> str:
 
 
 
+# ─── HTTP cache ──────────────────────────────────────────────────────────────
+class HttpCache:
+    """Дисковый кэш страниц с валидаторами ETag / Last-Modified."""
+
+    def __init__(self, directory: Path = HTTP_CACHE_DIR):
+        self.dir = directory
+        self.index_file = directory / "index.json"
+        self.index = load_json(self.index_file, {})
+        self.max_bytes = int(HTTP_CACHE_MAX_MB * 1024 * 1024)
+        self.max_age = HTTP_CACHE_MAX_AGE_DAYS * 86400
+        self.hits = 0
+        self.misses = 0
+
+    def _body_path(self, url: str) -> Path:
+        return self.dir / (hashlib.sha1(url.encode("utf-8")).hexdigest() + ".html")
+
+    def _drop(self, url: str):
+        self.index.pop(url, None)
+        try:
+            self._body_path(url).unlink()
+        except OSError:
+            pass
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        entry = self.index.get(url)
+        if not entry or not self._body_path(url).exists():
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get(self, url: str) -> Optional[str]:
+        # Вызывается на 304: тело берём с диска
+        try:
+            body = self._body_path(url).read_text(encoding="utf-8")
+        except OSError:
+            self._drop(url)
+            return None
+        self.index[url]["used"] = time.time()
+        self.hits += 1
+        return body
+
+    def put(self, url: str, body: str, etag: Optional[str], last_modified: Optional[str]):
+        self.misses += 1
+        # Без валидаторов повторно проверить страницу нельзя — хранить нечего
+        if not etag and not last_modified:
+            self._drop(url)
+            return
+        try:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            path = self._body_path(url)
+            path.write_text(body, encoding="utf-8")
+        except OSError as e:
+            logger.error(f"HTTP-кэш {url}: {e}")
+            return
+        now = time.time()
+        self.index[url] = {
+            "etag": etag, "last_modified": last_modified,
+            "size": path.stat().st_size, "stored": now, "used": now,
+        }
+
+    def save(self):
+        now = time.time()
+        for url, entry in list(self.index.items()):
+            if now - entry.get("stored", 0) > self.max_age:
+                self._drop(url)
+
+        # Вытесняем давно не использованные записи, пока не уложимся в лимит
+        total = sum(e.get("size", 0) for e in self.index.values())
+        for url, entry in sorted(self.index.items(), key=lambda kv: kv[1].get("used", 0)):
+            if total <= self.max_bytes:
+                break
+            total -= entry.get("size", 0)
+            self._drop(url)
+
+        save_json(self.index_file, self.index)
+        logger.info(f"🗄️ HTTP-кэш: 304 — {self.hits}, загружено — {self.misses}, записей — {len(self.index)}")
+
+
+# ─── HTTP fixtures ───────────────────────────────────────────────────────────
+class FixtureCorpus:
+    """Записанные ответы: index.json (URL → статус и заголовки) и тела в bodies/<sha256>.gz без повторов."""
+
+    KEEP_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+    def __init__(self, root: Path = HTTP_FIXTURES_DIR):
+        self.root = root
+        self.index = load_json(root / "index.json", {})
+        self.missing = 0
+
+    def get(self, url: str) -> Optional[tuple]:
+        entry = self.index.get(url)
+        if not entry:
+            self.missing += 1
+            logger.warning(f"🧪 Нет в корпусе: {url}")
+            return None
+        import gzip
+        body = gzip.decompress((self.root / "bodies" / f"{entry['body']}.gz").read_bytes())
+        return entry["status"], entry["headers"], body
+
+    def put(self, url: str, status: int, headers, body: bytes):
+        import gzip
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.root / "bodies" / f"{digest}.gz"
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # mtime=0 — одинаковое тело даёт одинаковый файл, корпус не шумит в git diff
+            path.write_bytes(gzip.compress(body, mtime=0))
+        kept = {k: headers[k] for k in self.KEEP_HEADERS if k in headers}
+        self.index[url] = {"status": status, "headers": kept, "body": digest}
+
+    def save(self):
+        save_json(self.root / "index.json", self.index)
+        logger.info(f"🧪 Корпус {self.root}: ответов {len(self.index)}, не найдено {self.missing}")
+
+
+class FixtureResponse:
+    """Ответ из корпуса с тем же интерфейсом, что использует бот у aiohttp: status, headers, text/read, content."""
+
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes, range_header: Optional[str] = None):
+        self.status, self.headers, self.body = status, dict(headers), body
+        m = re.match(r"bytes=(\d+)-(\d*)", range_header or "")
+        # Корпус хранит тела целиком, Range режем на лету — как сделал бы сервер
+        if m and status == 200:
+            start = int(m.group(1))
+            end = min(int(m.group(2)) if m.group(2) else len(body) - 1, len(body) - 1)
+            self.status = 206
+            self.headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            self.body = body[start:end + 1]
+        self.headers["Content-Length"] = str(len(self.body))
+        self.content = self
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self) -> str:
+        charset = re.search(r"charset=([\w-]+)", self.headers.get("Content-Type", ""))
+        return self.body.decode(charset.group(1) if charset else "utf-8", errors="replace")
+
+    async def iter_chunked(self, size: int):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+
+class FixtureSession:
+    """Вместо aiohttp.ClientSession: replay отдаёт ответы из корпуса, record ходит в сеть через session и пишет их."""
+
+    # Условные заголовки и Range при записи убираем: в корпус должно попасть полное тело, а не 304 или кусок
+    VOLATILE_HEADERS = {"range", "if-none-match", "if-modified-since"}
+
+    def __init__(self, corpus: FixtureCorpus, session=None):
+        self.corpus = corpus
+        self.session = session
+
+    @contextlib.asynccontextmanager
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs):
+        headers = headers or {}
+        if self.session is not None:
+            plain = {k: v for k, v in headers.items() if k.lower() not in self.VOLATILE_HEADERS}
+            async with self.session.get(url, headers=plain, **kwargs) as r:
+                self.corpus.put(url, r.status, r.headers, await r.read())
+        found = self.corpus.get(url)
+        status, stored_headers, body = found if found else (404, {}, b"")
+        yield FixtureResponse(status, stored_headers, body, headers.get("Range"))
+
+    async def close(self):
+        self.corpus.save()
+        if self.session is not None:
+            await self.session.close()
+
+
+class DryRunBot:
+    """Telegram в режиме фикстур: ничего не отправляет, только пишет в лог и возвращает правдоподобный ответ."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def _message(self, method: str, text: str):
+        from types import SimpleNamespace
+        self.sent += 1
+        logger.info(f"🧪 [dry-run] {method}: {(text or '').splitlines()[0][:60] if text else ''}")
+        # Без photo: фиктивный file_id не должен попасть в кэш file_id
+        return SimpleNamespace(message_id=self.sent, photo=None)
+
+    async def send_photo(self, caption: str = "", **kwargs):
+        return self._message("send_photo", caption)
+
+    async def send_message(self, text: str = "", **kwargs):
+        return self._message("send_message", text)
+
+    async def send_media_group(self, media, **kwargs):
+        return [self._message("send_media_group", getattr(m, "caption", "")) for m in media]
+
+    async def pin_chat_message(self, **kwargs):
+        return True
+
+
+# ─── Source fingerprints ─────────────────────────────────────────────────────
+# Части страниц, которые меняются без изменения содержимого (просмотры в t.me, одноразовые токены)
+_VOLATILE_RE = re.compile(
+    r'<span class="tgme_widget_message_views">[^<]*</span>|\bnonce="[^"]*"|<meta name="csrf[^>]*>'
+)
+
+class FingerprintStore:
+    """Хэш последней загруженной страницы каждого источника и извлечённые из неё события."""
+
+    def __init__(self, path: Path = FINGERPRINTS_FILE):
+        self.path = path
+        self.data = load_json(path, {})
+        self.hits = 0
+        self.changed = {}
+
+    @staticmethod
+    def digest(body: str) -> str:
+        return hashlib.sha256(_VOLATILE_RE.sub("", body).encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str, digest: str) -> Optional[List[Dict]]:
+        entry = self.data.get(key)
+        if entry and entry.get("hash") == digest:
+            self.hits += 1
+            self.changed[key] = False
+            return entry.get("events", [])
+        return None
+
+    def events(self, key: str) -> List[Dict]:
+        return self.data.get(key, {}).get("events", [])
+
+    def store(self, key: str, digest: str, events: List[Dict]):
+        self.changed[key] = self.data.get(key, {}).get("hash") != digest
+        # Копии: main() дописывает в события описание и фото, в отпечатке им не место
+        self.data[key] = {"hash": digest, "events": [dict(e) for e in events], "ts": time.time()}
+
+    def save(self):
+        save_json(self.path, self.data)
+        logger.info(f"🧬 Неизменившихся страниц (без парсинга): {self.hits}")
+
+
+# ─── Source health ───────────────────────────────────────────────────────────
+class TransientHTTPError(Exception):
+    pass
+
+@functools.lru_cache(maxsize=None)
+def transient_errors() -> tuple:
+    import aiohttp
+    return (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, TransientHTTPError)
+
+class SourceHealth:
+    """Сбои по хостам и предохранитель: closed → open (пауза) → half-open (одна пробная загрузка)."""
+
+    def __init__(self, path: Path = SOURCE_HEALTH_FILE):
+        self.path = path
+        self.data = load_json(path, {})
+        self._probes = {}
+
+    def state(self, host: str) -> str:
+        entry = self.data.get(host)
+        if not entry or not entry.get("open_until"):
+            return "closed"
+        return "open" if time.time() < entry["open_until"] else "half-open"
+
+    def probe_lock(self, host: str) -> asyncio.Lock:
+        if host not in self._probes:
+            self._probes[host] = asyncio.Lock()
+        return self._probes[host]
+
+    def success(self, host: str):
+        entry = self.data.pop(host, None)
+        if entry and entry.get("open_until"):
+            logger.info(f"💚 {host}: источник снова доступен")
+
+    def failure(self, host: str):
+        entry = self.data.setdefault(host, {"failures": 0, "open_until": 0, "cooldown": BREAKER_COOLDOWN})
+        probe_failed = self.state(host) == "half-open"
+        entry["failures"] += 1
+        if probe_failed:
+            entry["cooldown"] = min(entry["cooldown"] * 2, BREAKER_MAX_COOLDOWN)
+        if probe_failed or entry["failures"] >= BREAKER_THRESHOLD:
+            entry["open_until"] = time.time() + entry["cooldown"]
+            logger.warning(f"⛔ {host}: {entry['failures']} сбоев подряд, пауза {entry['cooldown'] / 60:.0f} мин")
+
+    def save(self):
+        save_json(self.path, self.data)
+
+
+# ─── Adaptive schedule ───────────────────────────────────────────────────────
+class SourceScheduler:
+    """Решает, какие источники обходить в этом запуске, по выученной частоте их изменений."""
+
+    def __init__(self, path: Path = SCHEDULE_FILE):
+        self.path = path
+        self.data = load_json(path, {})
+
+    def interval(self, key: str, source: Dict) -> float:
+        if source.get("interval"):
+            return float(source["interval"]) * 60
+        return self.data.get(key, {}).get("interval", SCHEDULE_MIN_INTERVAL)
+
+    def due(self, sources: List[tuple]) -> set:
+        now = time.time()
+        forced, overdue = set(), []
+        for key, source in sources:
+            entry = self.data.get(key)
+            if source.get("always") or not entry:
+                forced.add(key)
+                continue
+            interval = self.interval(key, source)
+            # Постоянный сдвиг до 10% интервала по ключу разводит источники с одинаковым интервалом по разным тикам;
+            # минута запаса — потому что cron в Actions срабатывает неровно
+            offset = int(hashlib.md5(key.encode("utf-8")).hexdigest()[:4], 16) / 0xFFFF * 0.1 * interval
+            elapsed = now - entry.get("last_crawl", 0)
+            if elapsed + 60 >= interval + offset:
+                overdue.append((elapsed / interval, key))
+
+        # Если к обходу набралось слишком много — сначала самые просроченные, остальные в следующий тик
+        overdue.sort(reverse=True)
+        limit = max(0, SCHEDULE_MAX_PER_RUN - len(forced))
+        return forced | {key for _, key in overdue[:limit]}
+
+    def record(self, key: str, changed: Optional[bool]):
+        now = time.time()
+        entry = self.data.setdefault(key, {"interval": SCHEDULE_MIN_INTERVAL, "last_crawl": 0, "last_change": 0})
+        entry["last_crawl"] = now
+        if changed is None:
+            return  # Страница не загрузилась — о частоте изменений ничего не узнали
+        if changed:
+            entry["last_change"] = now
+            entry["interval"] = max(SCHEDULE_MIN_INTERVAL, entry["interval"] / 2)
+        else:
+            entry["interval"] = min(SCHEDULE_MAX_INTERVAL, entry["interval"] * 1.5)
+
+    def save(self):
+        save_json(self.path, self.data)
+
+
+# ─── Event details cache ─────────────────────────────────────────────────────
+class DetailsCache:
+    """Результаты fetch_event_details между запусками: TTL и лимит на число записей."""
+
+    def __init__(self, path: Path = DETAILS_CACHE_FILE):
+        self.path = path
+        self.data = load_json(path, {})
+        self.ttl = DETAILS_TTL_HOURS * 3600
+        self.hits = 0
+
+    def peek(self, link: str) -> Optional[Dict[str, str]]:
+        entry = self.data.get(link)
+        if not entry or time.time() - entry.get("ts", 0) > self.ttl:
+            return None
+        return {"desc": entry.get("desc", ""), "image": entry.get("image", "")}
+
+    def get(self, link: str) -> Optional[Dict[str, str]]:
+        cached = self.peek(link)
+        if cached is not None:
+            self.hits += 1
+        return cached
+
+    def put(self, link: str, details: Dict[str, str]):
+        self.data[link] = {"desc": details.get("desc", ""), "image": details.get("image", ""), "ts": time.time()}
+
+    def save(self):
+        now = time.time()
+        fresh = {k: v for k, v in self.data.items() if now - v.get("ts", 0) <= self.ttl}
+        # Сверх лимита выбрасываем самые старые записи
+        if len(fresh) > DETAILS_CACHE_MAX:
+            newest = sorted(fresh.items(), key=lambda kv: kv[1].get("ts", 0), reverse=True)[:DETAILS_CACHE_MAX]
+            fresh = dict(newest)
+        self.data = fresh
+        save_json(self.path, self.data)
+        logger.info(f"📄 Детали из кэша: {self.hits}")
+
+
+# ─── Telegram file_id cache ──────────────────────────────────────────────────
+class FileIdCache:
+    """URL обложки → sha256 содержимого → file_id первой загрузки в Telegram.
+
+    По известному URL не нужно ни скачивать, ни загружать картинку; тот же постер по другому URL
+    скачивается, но по хэшу тоже уходит ссылкой на file_id."""
+
+    def __init__(self, path: Path = FILE_IDS_FILE):
+        self.path = path
+        data = load_json(path, {})
+        self.urls = data.get("urls", {})
+        self.hashes = data.get("hashes", {})
+        self.ttl = FILE_ID_TTL_DAYS * 86400
+        self.hits = 0
+
+    @staticmethod
+    def digest(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def _fresh(self, entry: Optional[Dict]) -> bool:
+        return bool(entry) and time.time() - entry.get("ts", 0) <= self.ttl
+
+    def by_url(self, url: str) -> Optional[str]:
+        entry = self.urls.get(url)
+        if not self._fresh(entry):
+            return None
+        return self.by_hash(entry["hash"])
+
+    def by_hash(self, digest: str) -> Optional[str]:
+        entry = self.hashes.get(digest)
+        if not self._fresh(entry):
+            return None
+        self.hits += 1
+        return entry["file_id"]
+
+    def remember_url(self, url: str, digest: str):
+        self.urls[url] = {"hash": digest, "ts": time.time()}
+
+    def put(self, url: str, digest: str, file_id: str):
+        self.remember_url(url, digest)
+        self.hashes[digest] = {"file_id": file_id, "ts": time.time()}
+
+    def forget(self, url: str, digest: Optional[str]):
+        # Telegram не принял file_id (например, сменился токен бота) — в следующий раз загрузим заново
+        self.urls.pop(url, None)
+        if digest:
+            self.hashes.pop(digest, None)
+
+    def save(self):
+        now = time.time()
+        urls = {k: v for k, v in self.urls.items() if now - v.get("ts", 0) <= self.ttl}
+        hashes = {k: v for k, v in self.hashes.items() if now - v.get("ts", 0) <= self.ttl}
+        if len(hashes) > FILE_ID_CACHE_MAX:
+            hashes = dict(sorted(hashes.items(), key=lambda kv: kv[1].get("ts", 0), reverse=True)[:FILE_ID_CACHE_MAX])
+        self.urls = {k: v for k, v in urls.items() if v.get("hash") in hashes}
+        self.hashes = hashes
+        save_json(self.path, {"urls": self.urls, "hashes": self.hashes})
+        logger.info(f"🖼️ Обложек по file_id (без загрузки): {self.hits}")
+
+
+# ─── Cover images ────────────────────────────────────────────────────────────
+def recompress_photo(data: bytes, crop: Optional[List[float]] = None) -> bytes:
+    """Обложка для загрузки: длинная сторона не больше IMAGE_MAX_SIDE, прогрессивный JPEG.
+    crop — [верх, низ] в долях высоты (см. smart_crop_box).
+    Если Pillow нет, картинка не читается или результат не меньше — отдаём исходные байты."""
+    try:
+        from io import BytesIO
+        from PIL import Image, ImageOps
+    except ImportError:
+        return data
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            if getattr(img, "is_animated", False) and img.format not in JPEG_FORMATS:
+                return data
+            oversized = max(img.size) > IMAGE_MAX_SIDE or crop is not None
+            if oversized and img.format in JPEG_FORMATS:
+                # Большой JPEG декодируется сразу в уменьшенном масштабе (DCT), а не целиком
+                img.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+            img = ImageOps.exif_transpose(img)
+            if crop is not None:
+                img = img.crop((0, round(crop[0] * img.height), img.width, round(crop[1] * img.height)))
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            if max(img.size) > IMAGE_MAX_SIDE:
+                img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+            out = BytesIO()
+            img.save(out, "JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+    except Exception as e:
+        logger.warning(f"🖼️ Не удалось пережать обложку, отправляем как есть: {e}")
+        return data
+
+    result = out.getvalue()
+    # Небольшой JPEG без уменьшения не пережимаем ради пережатия: только потеря качества
+    if not oversized and len(result) >= len(data):
+        return data
+    return result
+
+
+def cover_verdict(fmt: str, width: int, height: int) -> Optional[str]:
+    """Причина отказа по формату и размерам обложки или None, если она годится."""
+    if fmt in IMAGE_REJECT_FORMATS:
+        return f"формат {fmt}"
+    if min(width, height) < IMAGE_MIN_SIDE:
+        return f"слишком мелкая {width}x{height}"
+    if max(width, height) < IMAGE_ICON_SIDE and 0.9 <= width / height <= 1.1:
+        return f"похожа на иконку {width}x{height}"
+    return None
+
+
+async def probe_image(session, url: str) -> tuple:
+    """(причина отказа или None, байты картинки, если она целиком уместилась в пробу).
+
+    Просим у сервера только первые IMAGE_PROBE_BYTES (Range) и читаем поток, пока Pillow не разберёт
+    заголовок; если Range не поддерживается, тот же поток просто обрывается. Неизвестное — не повод отказать."""
+    try:
+        from PIL import ImageFile
+    except ImportError:
+        return None, None
+
+    parser = ImageFile.Parser()
+    data = bytearray()
+    headers = {"Range": f"bytes=0-{IMAGE_PROBE_BYTES - 1}", "Accept-Encoding": "identity"}
+    try:
+        async with session.get(url, headers=headers) as resp:
+            if resp.status not in (200, 206):
+                return None, None
+            content_type = resp.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            # application/octet-stream у CDN бывает и у настоящих картинок — отказываем только HTML/тексту
+            if content_type.startswith("text/"):
+                return f"не картинка ({content_type})", None
+            if resp.status == 206:
+                total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+            else:
+                total = resp.headers.get("Content-Length", "")
+            total = int(total) if total.isdigit() else None
+            # Маленькую картинку дочитываем целиком — полная загрузка тогда не нужна
+            whole = total is not None and total <= IMAGE_PROBE_BYTES
+
+            async for chunk in resp.content.iter_chunked(4096):
+                data += chunk
+                if parser.image is None:
+                    parser.feed(chunk)
+                if parser.image is not None and not whole:
+                    break
+                if len(data) >= IMAGE_PROBE_BYTES:
+                    break
+    except Exception as e:
+        logger.debug(f"Проба обложки не удалась {url}: {e}")
+        return None, None
+
+    if parser.image is None:
+        # Заголовок не разобрался: SVG/ICO/HTML-заглушку Pillow не откроет, а у JPEG мог быть огромный EXIF
+        if content_type in ("image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon"):
+            return f"формат {content_type}", None
+        return None, None
+
+    width, height = parser.image.size
+    reason = cover_verdict(parser.image.format, width, height)
+    complete = whole and total is not None and len(data) == total
+    return reason, (bytes(data) if complete and not reason else None)
+
+
+def dhash(data: bytes) -> Optional[int]:
+    """64-битный difference hash: яркость 9x8, бит — «правый пиксель ярче левого». None без Pillow/NumPy."""
+    try:
+        from io import BytesIO
+        import numpy as np
+        from PIL import Image
+    except ImportError:
+        return None
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img.draft("L", (64, 64))
+            small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    except Exception:
+        return None
+    px = np.asarray(small, dtype=np.int16)
+    bits = (px[:, 1:] > px[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+# ─── Smart crop ──────────────────────────────────────────────────────────────
+CROP_DATE_RE = re.compile(
+    r"\b\d{1,2}[:.]\d{2}\b|"
+    r"\b\d{1,2}\s*(янв|фев|мар|апр|май|июн|июл|авг|сен|окт|ноя|дек)\b|"
+    r"\b\d{4}\b|"
+    r"\b(january|february|march|april|may|june|july|august|september|october|november|december)\b",
+    re.IGNORECASE
+)
+
+def load_gray(data: bytes):
+    """Афиша как массив яркости (uint8) с учётом EXIF-поворота."""
+    from io import BytesIO
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(data)) as img:
+        return np.asarray(ImageOps.exif_transpose(img).convert("L"))
+
+
+def ocr_words(gray, top: int = 0) -> List[tuple]:
+    """(текст, y, высота) слов Tesseract; y — в координатах всей афиши, если gray — полоса с отступом top."""
+    import pytesseract
+
+    ocr = pytesseract.image_to_data(gray, output_type=pytesseract.Output.DICT)
+    return [(t.strip(), y + top, bh) for t, y, bh in zip(ocr["text"], ocr["top"], ocr["height"]) if t.strip()]
+
+
+def crop_from_words(words: List[tuple], h: int) -> Optional[List[float]]:
+    # Правило прежнего OCR-кропа: дата в верхних 45% режется вместе со всем, что выше, в нижних — со всем, что ниже
+    detected_top = [y + bh for text, y, bh in words if CROP_DATE_RE.search(text) and y < h * 0.45]
+    detected_bottom = [y for text, y, bh in words if CROP_DATE_RE.search(text) and y > h * 0.55]
+    crop_top = max(detected_top) + CROP_MARGIN if detected_top else 0
+    crop_bottom = min(detected_bottom) - CROP_MARGIN if detected_bottom else h
+    if crop_bottom - crop_top < h * 0.45 or (crop_top, crop_bottom) == (0, h):
+        return None
+    return [crop_top / h, crop_bottom / h]
+
+
+def ocr_crop_box(data: bytes) -> Optional[List[float]]:
+    """Эталон: OCR всей афиши (как smart_crop_text_zones в «bot best.py»). Медленно — только для сравнения."""
+    gray = load_gray(data)
+    return crop_from_words(ocr_words(gray), gray.shape[0])
+
+
+def text_bands(gray, work_width: int = 600) -> Optional[List[tuple]]:
+    """Горизонтальные полосы с текстом (top, bottom) в пикселях gray: строки с высокой плотностью
+    вертикальных штрихов (резких перепадов яркости по горизонтали) после сглаживания по высоте.
+    None — фон сам по себе «штрихованный» (фактура фото), и текст по плотности не отличить."""
+    import numpy as np
+
+    h, w = gray.shape
+    step = max(1, w // work_width)
+    g = gray[:, ::step].astype(np.int16)
+    edges = np.abs(np.diff(g, axis=1)) > 24
+    density = edges.mean(axis=1)
+    k = max(3, h // 150)
+    density = np.convolve(density, np.ones(k) / k, mode="same")
+    background = float(np.median(density))
+    if background > 0.1:
+        return None
+    # Порог от «фона» афиши: текст заметно плотнее медианной строки
+    is_text = density > max(0.03, background * 2.5)
+
+    bands, start = [], None
+    for y, flag in enumerate(np.append(is_text, False)):
+        if flag and start is None:
+            start = y
+        elif not flag and start is not None:
+            bands.append([start, y])
+            start = None
+    # Строки одного блока (межстрочный интервал) склеиваем, совсем тонкие полосы — шум
+    merged = []
+    for band in bands:
+        if merged and band[0] - merged[-1][1] <= max(2, h // 100):
+            merged[-1][1] = band[1]
+        else:
+            merged.append(band)
+    return [(a, b) for a, b in merged if b - a >= max(4, h // 100)]
+
+
+@functools.lru_cache(maxsize=None)
+def has_ocr() -> bool:
+    import importlib.util
+    return importlib.util.find_spec("pytesseract") is not None
+
+
+def smart_crop_box(data: bytes) -> Optional[List[float]]:
+    """[верх, низ] обрезки в долях высоты или None. Дешёвая разметка полос текста решает без OCR только отказ:
+    обрезать нечего или обрезка оставила бы меньше 45%. Что резать, решают слова с датой из OCR спорных полос —
+    как у OCR всей афиши; без pytesseract обрезки нет."""
+    import numpy as np
+
+    if not has_ocr():
+        return None
+    gray = load_gray(data)
+    h = gray.shape[0]
+    bands = text_bands(gray)
+
+    # Фактура фотографии похожа на текст везде — полосам верить нельзя, решает OCR всей афиши
+    if bands is None or sum(b - a for a, b in bands) > h * 0.6:
+        return crop_from_words(ocr_words(gray), h)
+
+    top_bands = [(a, b) for a, b in bands if a < h * 0.45]
+    bottom_bands = [(a, b) for a, b in bands if b > h * 0.55]
+    if not top_bands and not bottom_bands:
+        return None
+
+    # Даже самая скромная обрезка (одна ближайшая к краю полоса) оставила бы меньше 45% — OCR ничего не изменит
+    top_only = h - (min(b for a, b in top_bands) + CROP_MARGIN) if top_bands else 0
+    bottom_only = max(a for a, b in bottom_bands) - CROP_MARGIN if bottom_bands else 0
+    if max(top_only, bottom_only) < h * 0.45:
+        return None
+
+    words = []
+    pad = max(4, h // 100)
+    for a, b in top_bands + [band for band in bottom_bands if band not in top_bands]:
+        top = max(0, a - pad)
+        words += ocr_words(np.ascontiguousarray(gray[top:min(h, b + pad)]), top)
+    return crop_from_words(words, h)
+
+
+class CropCache:
+    """Результат smart_crop_box по sha256 содержимого: повторная афиша не декодируется и не распознаётся заново."""
+
+    def __init__(self, path: Path = CROPS_FILE):
+        self.path = path
+        self.data = load_json(path, {})
+        self.hits = 0
+
+    def get(self, sha: str) -> tuple:
+        # (найдено, рамка): None — тоже ответ («резать нечего»)
+        entry = self.data.get(sha)
+        if entry is None:
+            return False, None
+        self.hits += 1
+        return True, entry["box"]
+
+    def put(self, sha: str, box: Optional[List[float]]):
+        self.data[sha] = {"box": box, "ts": time.time()}
+
+    def save(self):
+        if len(self.data) > SMART_CROP_CACHE_MAX:
+            newest = sorted(self.data.items(), key=lambda kv: kv[1].get("ts", 0), reverse=True)[:SMART_CROP_CACHE_MAX]
+            self.data = dict(newest)
+        save_json(self.path, self.data)
+        logger.info(f"✂️ Обрезка афиш из кэша: {self.hits}")
+
+
+class ImageHashIndex:
+    """dHash обложек опубликованных ивентов: ссылка → хэш, sha256 содержимого и дата ивента."""
+
+    def __init__(self, path: Path = IMAGE_HASHES_FILE):
+        self.path = path
+        today = datetime.now().date().isoformat()
+        cutoff = time.time() - PHASH_TTL_DAYS * 86400
+        # Прошедшие ивенты больше не дубли: их постер может вернуться на новой дате
+        self.data = {
+            link: v for link, v in load_json(path, {}).items()
+            if (v.get("event_date") or "") >= today or (not v.get("event_date") and v.get("ts", 0) >= cutoff)
+        }
+        self._links = None
+        self._hashes = None
+        self.suppressed = 0
+
+    def by_sha(self, sha: Optional[str]) -> Optional[int]:
+        # Для обложек, ушедших по file_id без скачивания
+        for v in self.data.values():
+            if sha and v.get("sha") == sha:
+                return int(v["phash"], 16)
+        return None
+
+    def _matrix(self):
+        import numpy as np
+        if self._hashes is None:
+            self._links = list(self.data)
+            self._hashes = np.array([int(self.data[k]["phash"], 16) for k in self._links], dtype=np.uint64)
+        return self._links, self._hashes
+
+    def nearest(self, phash: int) -> List[tuple]:
+        """(ссылка, расстояние) для всех записей не дальше PHASH_DISTANCE."""
+        import numpy as np
+        links, hashes = self._matrix()
+        if not links:
+            return []
+        xor = hashes ^ np.uint64(phash)
+        distances = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+        return [(links[i], int(distances[i])) for i in np.flatnonzero(distances <= PHASH_DISTANCE)]
+
+    def duplicate_of(self, phash: Optional[int], event_date: Optional[str], pending: List[Dict] = ()) -> Optional[str]:
+        """Ссылка опубликованного (или ждущего в альбоме) ивента с той же обложкой на ту же дату."""
+        if phash is None:
+            return None
+        matches = [(link, self.data[link].get("event_date")) for link, _ in sorted(self.nearest(phash), key=lambda x: x[1])]
+        matches += [
+            (p["link"], p["event"].get("event_date")) for p in pending
+            if p["phash"] is not None and bin(p["phash"] ^ phash).count("1") <= PHASH_DISTANCE
+        ]
+        # Та же картинка на другую дату — это серия (еженедельный митап), а не дубль
+        for link, other_date in matches:
+            if not other_date or not event_date or other_date == event_date:
+                return link
+        return None
+
+    def add(self, link: str, phash: Optional[int], sha: Optional[str], event_date: Optional[str]):
+        if phash is None:
+            return
+        self.data[link] = {"phash": f"{phash:016x}", "sha": sha, "event_date": event_date, "ts": int(time.time())}
+        self._hashes = None
+
+    def save(self):
+        save_json(self.path, self.data)
+        logger.info(f"🖼️ Дублей по обложке отсеяно: {self.suppressed}, обложек в индексе: {len(self.data)}")
+
+
+# ─── Rejected candidates ─────────────────────────────────────────────────────
+def event_fingerprint(event: Dict, details: Dict[str, str]) -> str:
+    # Объявление и страница ивента (описание, og:image): вердикт устаревает, если изменилось хоть что-то
+    parts = [event.get(k) or "" for k in ("title", "date", "location", "full_text", "image_url")]
+    parts += [details.get("desc") or "", details.get("image") or ""]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+class RejectionIndex:
+    """Кандидаты, отклонённые make_post или без обложки, с причиной и сроком годности вердикта."""
+
+    def __init__(self, path: Path = REJECTED_FILE, db: Optional[SqliteState] = None):
+        self.path = path
+        self.db = db
+        today = datetime.now().date().isoformat()
+        self.data = {} if db else {k: v for k, v in load_json(path, {}).items() if v.get("expires", "") > today}
+        self.skipped = 0
+
+    def is_rejected(self, link: str, digest: str) -> bool:
+        if self.db:
+            rejected = self.db.is_rejected(link, digest)
+            self.skipped += rejected
+            return rejected
+        entry = self.data.get(link)
+        if not entry or entry.get("hash") != digest:
+            return False
+        if entry.get("expires", "") <= datetime.now().date().isoformat():
+            return False
+        self.skipped += 1
+        return True
+
+    def add(self, link: str, digest: str, reason: str, event_date: Optional[str]):
+        ttl_end = datetime.fromtimestamp(time.time() + REJECT_TTL_DAYS * 86400).date().isoformat()
+        expires = min(event_date, ttl_end) if event_date else ttl_end
+        if self.db:
+            self.db.add_verdict(link, digest, reason, expires)
+            return
+        self.data[link] = {"hash": digest, "reason": reason, "expires": expires}
+
+    def save(self):
+        if not self.db:
+            save_json(self.path, self.data)
+        logger.info(f"🙅 Отклонённых ранее (пропущены без проверки): {self.skipped}, в индексе: {len(self.data)}")
+
+
+# ─── Upcoming events (digest) ────────────────────────────────────────────────
+class UpcomingEvents:
+    """Все увиденные будущие ивенты, включая уже опубликованные: обход их пропускает, а дайджесту они нужны."""
+
+    FIELDS = ("title", "date", "location", "venue", "source", "event_date")
+
+    def __init__(self, path: Path = UPCOMING_FILE):
+        self.path = path
+        today = datetime.now().date().isoformat()
+        self.data = {k: v for k, v in load_json(path, {}).items() if v.get("event_date", "") >= today}
+
+    def record(self, events: List[Dict]):
+        for e in events:
+            link = normalize_link(e.get("link", ""))
+            if not link or not e.get("event_date"):
+                continue
+            entry = {k: e.get(k) for k in self.FIELDS}
+            entry["link"] = link
+            # Текст нужен только фильтрам make_post — начала хватает
+            entry["full_text"] = (e.get("full_text") or "")[:1000]
+            self.data[link] = entry
+
+    def events(self) -> List[Dict]:
+        return [dict(e) for e in self.data.values()]
+
+    def save(self):
+        save_json(self.path, self.data)
+
 
 class EventBot:
     def __init__(self):
         self.session = None
+        self.pool_stats = {"opened": 0, "reused": 0}
         self.posted = load_posted()
-
-    async def get_session(self) -> aiohttp.ClientSession:
+        self.db = self.posted if isinstance(self.posted, SqliteState) else None
+        self.http_cache = HttpCache()
+        self.fingerprints = FingerprintStore()
+        self.health = SourceHealth()
+        self.scheduler = SourceScheduler()
+        self.details_cache = DetailsCache()
+        self.rejected = RejectionIndex(db=self.db)
+        self.upcoming = UpcomingEvents()
+        self.file_ids = FileIdCache()
+        self.image_index = ImageHashIndex()
+        self.crops = CropCache()
+        if SMART_CROP and not has_ocr():
+            logger.warning("✂️ SMART_CROP=1, но pytesseract не установлен — афиши не обрезаются")
+        self._crop_pool = None
+        self._crawl_sem = None
+        self._host_sems = {}
+
+    async def _on_conn_opened(self, session, ctx, params):
+        self.pool_stats["opened"] += 1
+
+    async def _on_conn_reused(self, session, ctx, params):
+        self.pool_stats["reused"] += 1
+
+    async def get_session(self) -> "aiohttp.ClientSession":
+        if not self.session and HTTP_FIXTURES == "replay":
+            self.session = FixtureSession(FixtureCorpus())
         if not self.session:
+            import aiohttp
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_TTL,
+                use_dns_cache=True,
+                keepalive_timeout=HTTP_KEEPALIVE,
+                enable_cleanup_closed=True,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT
+            )
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_conn_opened)
+            trace.on_connection_reuseconn.append(self._on_conn_reused)
             self.session = aiohttp.ClientSession(
-                headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"}
+                connector=connector,
+                timeout=timeout,
+                trace_configs=[trace],
+                headers={
+                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
+                    "Accept-Encoding": accept_encoding(),
+                },
             )
+            if HTTP_FIXTURES == "record":
+                self.session = FixtureSession(FixtureCorpus(), self.session)
         return self.session
 
+    def save_state(self):
+        self.http_cache.save()
+        self.fingerprints.save()
+        self.health.save()
+        self.scheduler.save()
+        self.details_cache.save()
+        self.rejected.save()
+        self.upcoming.save()
+        self.file_ids.save()
+        self.image_index.save()
+        self.crops.save()
+
     async def close(self):
-        if self.session: await self.session.close()
+        self.save_state()
+        if self._crop_pool:
+            self._crop_pool.shutdown(cancel_futures=True)
+        if self.db:
+            self.db.close()
+        if self.session:
+            logger.info(f"🔌 Соединений: открыто {self.pool_stats['opened']}, переиспользовано {self.pool_stats['reused']}")
+            await self.session.close()
+
+    async def _fetch_once(self, url: str) -> str:
+        s = await self.get_session()
+        headers = self.http_cache.conditional_headers(url)
+        async with s.get(url, headers=headers) as r:
+            if r.status == 304:
+                cached = self.http_cache.get(url)
+                return cached if cached is not None else ""
+            if r.status in RETRY_STATUSES:
+                raise TransientHTTPError(f"HTTP {r.status}")
+            if r.status != 200:
+                return ""
+            body = await r.text()
+            self.http_cache.put(url, body, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+            return body
+
+    async def _fetch_with_retries(self, url: str, host: str, retries: int) -> str:
+        for attempt in range(retries + 1):
+            try:
+                body = await self._fetch_once(url)
+            except transient_errors() as e:
+                if attempt < retries:
+                    await asyncio.sleep(FETCH_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+                    continue
+                logger.error(f"fetch {url}: {e!r}")
+                self.health.failure(host)
+                return ""
+            except Exception as e:
+                logger.error(f"fetch {url}: {e}")
+                return ""
+            self.health.success(host)
+            return body
+        return ""
 
     async def fetch(self, url: str) -> str:
-        try:
-            s = await self.get_session()
-            async with s.get(url, timeout=15) as r:
-                return await r.text() if r.status == 200 else ""
-        except Exception as e:
-            logger.error(f"fetch {url}: {e}")
+        host = urlparse(url).netloc
+        state = self.health.state(host)
+        if state == "open":
+            logger.info(f"⛔ {host}: пропускаем до конца паузы")
             return ""
+        if state == "half-open":
+            # Один пробный запрос без повторов; остальные ждут его исхода
+            async with self.health.probe_lock(host):
+                if self.health.state(host) == "half-open":
+                    logger.info(f"🩺 {host}: пробная загрузка")
+                    return await self._fetch_with_retries(url, host, retries=0)
+            if self.health.state(host) == "open":
+                return ""
+        return await self._fetch_with_retries(url, host, FETCH_RETRIES)
+
+    @staticmethod
+    def has_details_page(url: str) -> bool:
+        return bool(url) and url.startswith("http") and "t.me" not in url
+
+    def known_details(self, url: str) -> Optional[Dict[str, str]]:
+        """Детали без сети: пустые, если страницы нет, из кэша — или None, если они ещё неизвестны."""
+        if not self.has_details_page(url):
+            return {"desc": "", "image": ""}
+        return self.details_cache.peek(normalize_link(url))
 
     async def fetch_event_details(self, url: str) -> Dict[str, str]:
-        result = {"desc": "", "image": ""}
-        if not url or not url.startswith("http") or "t.me" in url:
+        # ok=False — страницу получить не удалось (таймаут, открытый предохранитель): по пустым деталям судить нельзя
+        result = {"desc": "", "image": "", "ok": True}
+        if not self.has_details_page(url):
             return result
 
+        key = normalize_link(url)
+        cached = self.details_cache.get(key)
+        if cached is not None:
+            return {**cached, "ok": True}
+
+        result["ok"] = False
         try:
             html = await self.fetch(url)
             if not html: return result
-            soup = BeautifulSoup(html, "html.parser")
+            soup = make_soup(html)
 
             # 1. Фото (og:image)
             og_image = soup.find("meta", property="og:image")
@@ -835,6 +2345,9 @@ class EventBot:
                     
             if final_chunks:
                 result["desc"] = "\n".join(final_chunks)
+
+            result["ok"] = True
+            self.details_cache.put(key, result)
                     
         except Exception:
             pass
@@ -896,15 +2409,21 @@ class EventBot:
 
             events.append({
                 "title": title_clean, "date": format_date(dt, time_str), "location": location or "",
-                "venue": extract_venue(ctx), "link": link or post_link, "source": source, "image_url": image_url
+                "venue": extract_venue(ctx), "link": link or post_link, "source": source, "image_url": image_url,
+                "event_date": dt.date().isoformat()
             })
             i += 1
         return events
 
     async def parse_channel(self, channel: Dict) -> List[Dict]:
-        html = await self.fetch(f"https://t.me/s/{channel['username']}")
+        url = f"https://t.me/s/{channel['username']}"
+        html = await self.fetch(url)
         if not html: return []
-        soup = BeautifulSoup(html, "html.parser")
+        digest = FingerprintStore.digest(html)
+        cached = self.fingerprints.lookup(url, digest)
+        if cached is not None:
+            return self._reuse_events(cached)
+        soup = make_soup(html)
         all_events = []
 
         for msg in soup.find_all("div", class_="tgme_widget_message")[:20]:
@@ -991,31 +2510,105 @@ class EventBot:
 
                 all_events.append({
                     "title": title, "date": format_date(dt, time_str), "location": extract_location(text) or city_from_title or "",
-                    "venue": extract_venue(text), "link": final_link, "source": channel["name"], "full_text": text, "image_url": image_url
+                    "venue": extract_venue(text), "link": final_link, "source": channel["name"], "full_text": text, "image_url": image_url,
+                    "event_date": dt.date().isoformat()
                 })
             except Exception as e:
                 logger.error(f"parse_channel error: {e}")
                 continue
+        self.fingerprints.store(url, digest, all_events)
         return all_events
     
+    def _reuse_events(self, events: List[Dict], limit: Optional[int] = None) -> List[Dict]:
+        # Отдаём сохранённые события, отбросив прошедшие и уже опубликованные; лимит — после фильтра,
+        # иначе неопубликованные события неизменившейся страницы так и не дойдут до очереди
+        today = datetime.now().date().isoformat()
+        fresh = [
+            dict(e) for e in events
+            if e.get("event_date", "") > today and normalize_link(e.get("link", "")) not in self.posted
+        ]
+        return fresh[:limit]
+
+    async def crop_box(self, sha: str, data: bytes) -> Optional[List[float]]:
+        found, box = self.crops.get(sha)
+        if found:
+            return box
+        # Без OCR обрезки не бывает — незачем декодировать афишу в пуле процессов
+        if not has_ocr():
+            return None
+        # Декодирование, numpy и tesseract — CPU: в отдельных процессах, мимо GIL и event loop
+        if self._crop_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self._crop_pool = ProcessPoolExecutor(max_workers=max(1, SMART_CROP_WORKERS))
+        try:
+            box = await asyncio.get_running_loop().run_in_executor(self._crop_pool, smart_crop_box, data)
+        except Exception as e:
+            logger.warning(f"✂️ Не удалось разметить афишу: {e}")
+            return None
+        self.crops.put(sha, box)
+        return box
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self._host_sems:
+            self._host_sems[host] = asyncio.Semaphore(max(1, CRAWL_PER_HOST))
+        return self._host_sems[host]
+
+    async def _crawl_source(self, name: str, url: str, parse, source: Dict) -> List[Dict]:
+        async with self._crawl_sem, self._host_semaphore(url):
+            started = time.perf_counter()
+            try:
+                evs = await parse(source)
+            except Exception as e:
+                logger.error(f"❌ {name}: {e}")
+                evs = []
+            self.scheduler.record(url, self.fingerprints.changed.pop(url, None))
+            elapsed = time.perf_counter() - started
+            if self.db:
+                self.db.record_source(url, name, len(evs), elapsed)
+            logger.info(f"⏱️ {name}: {len(evs)} событий за {elapsed:.2f}с")
+            return evs
+
+    async def _scheduled_out(self, url: str, limit: Optional[int] = None) -> List[Dict]:
+        return self._reuse_events(self.fingerprints.events(url), limit)
+
     async def get_all_events(self) -> List[Dict]:
-        all_events = []
-        logger.info(f"🌐 Парсинг {len(URLS)} сайтов...")
-        for site in URLS:
-            evs = await self.parse_site(site)
-            all_events.extend(evs)
+        sources = [(site["url"], site["name"], self.parse_site, site) for site in URLS]
+        sources += [(f"https://t.me/s/{ch['username']}", ch["name"], self.parse_channel, ch) for ch in TELEGRAM_CHANNELS]
+
+        if ADAPTIVE_SCHEDULE:
+            due = self.scheduler.due([(url, source) for url, _, _, source in sources])
+        else:
+            due = {url for url, _, _, _ in sources}
+
+        logger.info(f"🌐 К обходу {len(due)} из {len(sources)} источников "
+                    f"(параллельно: {CRAWL_CONCURRENCY}, на хост: {CRAWL_PER_HOST})...")
+        started = time.perf_counter()
+        self._crawl_sem = asyncio.Semaphore(max(1, CRAWL_CONCURRENCY))
 
-        logger.info(f"📱 Парсинг {len(TELEGRAM_CHANNELS)} каналов...")
-        for ch in TELEGRAM_CHANNELS:
-            evs = await self.parse_channel(ch)
+        # gather сохраняет порядок задач: сначала сайты, затем каналы — как при последовательном обходе.
+        # Источники, которым ещё рано, отдают события, сохранённые при прошлом обходе
+        tasks = [
+            self._crawl_source(name, url, parse, source) if url in due
+            else self._scheduled_out(url, SITE_EVENTS_MAX if parse == self.parse_site else None)
+            for url, name, parse, source in sources
+        ]
+
+        all_events = []
+        for evs in await asyncio.gather(*tasks):
             all_events.extend(evs)
 
+        logger.info(f"⏱️ Обход источников: {time.perf_counter() - started:.2f}с, событий: {len(all_events)}")
         return all_events
 
     async def parse_site(self, site: Dict) -> List[Dict]:
         html = await self.fetch(site["url"])
         if not html: return []
-        soup = BeautifulSoup(html, "html.parser")
+        digest = FingerprintStore.digest(html)
+        cached = self.fingerprints.lookup(site["url"], digest)
+        if cached is not None:
+            return self._reuse_events(cached, SITE_EVENTS_MAX)
+        soup = make_soup(html)
         events = []
 
         for link in soup.find_all("a", href=True)[:80]:
@@ -1030,7 +2623,6 @@ class EventBot:
 
                 href = normalize_link(href)
                 if href.rstrip("/") == normalize_link(site["url"]).rstrip("/"): continue
-                if href in self.posted: continue
                 if is_site_trash(title_raw): continue
                 if not is_real_event(title_raw): continue
 
@@ -1072,24 +2664,225 @@ class EventBot:
                 title_clean = clean_title_deterministic(title_raw) or strip_emoji(dedup_title(title_raw))[:120]
                 events.append({
                     "title": title_clean, "date": format_date(dt, time_str), "location": extract_location(context) or "",
-                    "venue": extract_venue(context), "link": href, "full_text": context, "source": site["name"], "image_url": image_url
+                    "venue": extract_venue(context), "link": href, "full_text": context, "source": site["name"], "image_url": image_url,
+                    "event_date": dt.date().isoformat()
                 })
-                if len(events) >= 5: break
             except Exception:
                 continue
-        return events
+        # В отпечаток — все события страницы: опубликованные и лимит отсекаются при каждой выдаче
+        self.fingerprints.store(site["url"], digest, events)
+        return self._reuse_events(events, SITE_EVENTS_MAX)
 # ─── main ────────────────────────────────────────────────────────────────────
-async def main():
-    logger.info("🚀 Старт...")
-    if not BOT_TOKEN:
-        logger.error("❌ BOT_TOKEN не найден!")
+async def prepare_event(bot_obj: EventBot, event: Dict) -> Optional[Dict]:
+    """Детали, текст поста и обложка для одного кандидата; None — если публиковать нечего."""
+    norm_link = normalize_link(event.get("link", ""))
+
+    # 🔥 1. Получаем описание и качественное фото
+    details = await bot_obj.fetch_event_details(norm_link)
+
+    # Вердикт запоминаем, только если страница ивента действительно получена: временный сбой — не отказ
+    digest = None
+    if isinstance(details, dict) and details.get("ok"):
+        digest = event_fingerprint(event, details)
+
+    def remember_rejection(reason: str):
+        if digest:
+            bot_obj.rejected.add(norm_link, digest, reason, event.get("event_date"))
+
+    # На случай, если details это словарь (с новым кодом)
+    if isinstance(details, dict):
+        if details.get("desc"):
+            event["deep_description"] = details["desc"]
+        if details.get("image"):
+            event["image_url"] = details["image"]
+    # На случай, если details это просто строка (со старым кодом)
+    elif isinstance(details, str) and details:
+        event["deep_description"] = details
+
+    # 🔥 Убираем скриншоты для Google Форм (они всегда выглядят ужасно)
+    if any(domain in norm_link for domain in ["docs.google.com", "forms.gle"]):
+        event["image_url"] = None
+
+    text = make_post(event)
+    if not text:
+        remember_rejection(event.get("reject_reason", ""))
+        return None
+
+    photo_url = event.get("image_url")
+    # Если нет фото (например Google Forms или статья без обложки), то мы просто пропускаем
+    if not photo_url:
+        logger.info(f"🚫 Пропускаем ивент (нет обложки): {event.get('title')[:50]}")
+        remember_rejection("no_cover")
+        return None
+
+    prepared = {"event": event, "link": norm_link, "text": text, "digest": digest,
+                "photo_url": photo_url, "photo_hash": None, "phash": None}
+
+    # Эту обложку Telegram уже видел — ни скачивать, ни загружать её не нужно
+    file_id = bot_obj.file_ids.by_url(photo_url)
+    if file_id:
+        prepared["photo"] = file_id
+        prepared["photo_hash"] = bot_obj.file_ids.urls[photo_url]["hash"]
+        prepared["phash"] = bot_obj.image_index.by_sha(prepared["photo_hash"])
+        return prepared
+
+    session = await bot_obj.get_session()
+    reason, photo_bytes = await probe_image(session, photo_url)
+    if reason:
+        logger.info(f"🚫 Пропускаем ивент (обложка {reason}): {event.get('title')[:50]}")
+        remember_rejection("bad_cover")
+        return None
+
+    try:
+        # 🔥 2. НАДЕЖНАЯ ОТПРАВКА: Скачиваем фото в буфер
+        if photo_bytes is None:
+            async with session.get(photo_url) as resp:
+                if resp.status != 200:
+                    raise Exception("Bad HTTP status for image")
+                photo_bytes = await resp.read()
+    except Exception as img_e:
+        logger.warning(f"🚫 Не удалось скачать фото, пропускаем ивент. Ошибка: {img_e}")
+        return None
+
+    # Тот же постер под другим URL: по хэшу содержимого
+    sha = bot_obj.file_ids.digest(photo_bytes)
+    prepared["photo_hash"] = sha
+    prepared["phash"] = await asyncio.to_thread(dhash, photo_bytes)
+    file_id = bot_obj.file_ids.by_hash(sha)
+    if file_id:
+        bot_obj.file_ids.remember_url(photo_url, sha)
+        prepared["photo"] = file_id
+        return prepared
+
+    crop = await bot_obj.crop_box(sha, photo_bytes) if SMART_CROP else None
+
+    # Декодирование и JPEG-кодирование — в отдельном потоке, чтобы не стопорить обход и отправку
+    started = time.perf_counter()
+    prepared["photo"] = await asyncio.to_thread(recompress_photo, photo_bytes, crop)
+    if len(prepared["photo"]) < len(photo_bytes):
+        logger.info(f"🗜️ Обложка: {len(photo_bytes) // 1024} → {len(prepared['photo']) // 1024} КБ "
+                    f"за {(time.perf_counter() - started) * 1000:.0f} мс")
+    return prepared
+
+
+def resolve_photo(bot_obj: EventBot, prepared: Dict):
+    # Кандидаты готовятся заранее: пока этот ждал в очереди, такую же картинку могли уже загрузить
+    if isinstance(prepared["photo"], bytes):
+        file_id = bot_obj.file_ids.by_hash(prepared["photo_hash"])
+        if file_id:
+            bot_obj.file_ids.remember_url(prepared["photo_url"], prepared["photo_hash"])
+            prepared["photo"] = file_id
+
+
+def mark_posted(bot_obj: EventBot, prepared: Dict):
+    event = prepared["event"]
+    bot_obj.posted.add(prepared["link"], event.get("event_date"), event.get("title", ""))
+    bot_obj.image_index.add(prepared["link"], prepared["phash"], prepared["photo_hash"], event.get("event_date"))
+
+
+def remember_file_id(bot_obj: EventBot, prepared: Dict, message):
+    # Запоминаем file_id только после настоящей загрузки байтов
+    if isinstance(prepared["photo"], str) or not getattr(message, "photo", None):
         return
+    bot_obj.file_ids.put(prepared["photo_url"], prepared["photo_hash"], message.photo[-1].file_id)
 
-    bot_obj = EventBot()
-    bot_api = Bot(token=BOT_TOKEN)
+
+_bot_api = None
+_sender = None
+
+def get_sender() -> TelegramSender:
+    global _sender
+    if _sender is None:
+        _sender = TelegramSender()
+    return _sender
+
+def get_bot_api():
+    # Клиент Telegram (и сам пакет telegram) поднимается только когда есть что отправить
+    global _bot_api
+    if _bot_api is None and HTTP_FIXTURES:
+        _bot_api = DryRunBot()
+    if _bot_api is None:
+        from telegram import Bot
+        _bot_api = Bot(token=BOT_TOKEN)
+    return _bot_api
+
+
+async def publish_single(bot_obj: EventBot, prepared: Dict) -> bool:
+    from telegram.error import TimedOut
+
+    resolve_photo(bot_obj, prepared)
+    try:
+        message = await get_sender().send(
+            get_bot_api(), "send_photo",
+            chat_id=CHANNEL_ID,
+            message_thread_id=MESSAGE_THREAD_ID,
+            photo=prepared["photo"],
+            caption=prepared["text"],
+            parse_mode="HTML",
+        )
+    except TimedOut as send_e:
+        # Пост мог уйти, а дубль в канале хуже пропуска — как и с альбомом, считаем его опубликованным
+        logger.warning(f"⌛ Таймаут отправки поста, считаем опубликованным. Ошибка: {send_e}")
+        mark_posted(bot_obj, prepared)
+        return True
+    except Exception as send_e:
+        logger.warning(f"🚫 Не удалось отправить пост, пропускаем ивент. Ошибка: {send_e}")
+        if isinstance(prepared["photo"], str):
+            bot_obj.file_ids.forget(prepared["photo_url"], prepared["photo_hash"])
+        return False
+
+    remember_file_id(bot_obj, prepared, message)
+    mark_posted(bot_obj, prepared)
+    return True
+
+
+async def publish_album(bot_obj: EventBot, batch: List[Dict]) -> List[Dict]:
+    """Пачка подготовленных ивентов одним альбомом (подпись у каждого фото); при ошибке — по одному."""
+    if len(batch) == 1:
+        return batch if await publish_single(bot_obj, batch[0]) else []
+
+    from telegram import InputMediaPhoto
+    from telegram.error import TimedOut
+
+    for p in batch:
+        resolve_photo(bot_obj, p)
+    media = [InputMediaPhoto(media=p["photo"], caption=p["text"], parse_mode="HTML") for p in batch]
+    try:
+        messages = await get_sender().send(
+            get_bot_api(), "send_media_group",
+            chat_id=CHANNEL_ID,
+            message_thread_id=MESSAGE_THREAD_ID,
+            media=media,
+        )
+    except TimedOut as send_e:
+        # Альбом мог уйти: и досылка по одному, и повтор в следующем запуске рискуют продублировать
+        # весь пакет, а дубль в канале хуже пропуска — считаем пачку опубликованной
+        logger.warning(f"⌛ Таймаут отправки альбома из {len(batch)}, считаем опубликованным. Ошибка: {send_e}")
+        for p in batch:
+            mark_posted(bot_obj, p)
+        return batch
+    except Exception as send_e:
+        logger.warning(f"📚 Альбом не отправился ({send_e}), публикуем по одному")
+        return [p for p in batch if await publish_single(bot_obj, p)]
+
+    for p, message in zip(batch, messages or []):
+        remember_file_id(bot_obj, p, message)
+    for p in batch:
+        mark_posted(bot_obj, p)
+    logger.info(f"📚 Альбом: {len(batch)} ивентов одним запросом")
+    return batch
+
+
+async def run_cycle(bot_obj: EventBot, stop: Optional[asyncio.Event] = None) -> int:
+    """Один проход: обход источников и публикация новых ивентов. stop прерывает публикацию между постами."""
+    producer_task = None
+    queue = asyncio.Queue(maxsize=max(1, PREFETCH_QUEUE))
 
     try:
         events = await bot_obj.get_all_events()
+        bot_obj.upcoming.record(events)
+        if bot_obj.db:
+            bot_obj.db.record_events(events)
 
         unique, seen = [], set()
         for e in events:
@@ -1101,73 +2894,365 @@ async def main():
         logger.info(f"📊 Уникальных будущих событий: {len(unique)}")
         logger.info(f"📦 Уже опубликовано: {len(bot_obj.posted)}")
 
-        posted = 0
-
-        for event in unique[:15]:
+        # Известные отказы отсеиваем до лимита в 15, чтобы они не занимали места новых кандидатов
+        candidates = []
+        for event in unique:
             norm_link = normalize_link(event.get("link", ""))
-
             if norm_link in bot_obj.posted:
                 logger.info(f"⏭️ Уже публиковалось: {event.get('title')[:50]}")
                 continue
+            # Без загруженных деталей хэш не сверить — такой кандидат проверяется заново
+            details = bot_obj.known_details(norm_link)
+            if details is not None and bot_obj.rejected.is_rejected(norm_link, event_fingerprint(event, details)):
+                continue
+            candidates.append(event)
+            if len(candidates) >= 15:
+                break
 
-            # 🔥 1. Получаем описание и качественное фото
-            details = await bot_obj.fetch_event_details(norm_link)
-            
-            # На случай, если details это словарь (с новым кодом)
-            if isinstance(details, dict):
-                if details.get("desc"):
-                    event["deep_description"] = details["desc"]
-                if details.get("image"):
-                    event["image_url"] = details["image"]
-            # На случай, если details это просто строка (со старым кодом)
-            elif isinstance(details, str) and details:
-                event["deep_description"] = details
-
-            # 🔥 Убираем скриншоты для Google Форм (они всегда выглядят ужасно)
-            if any(domain in norm_link for domain in ["docs.google.com", "forms.gle"]):
-                event["image_url"] = None
-
-            text = make_post(event)
-            if not text:
+        # Детали и обложки качаются заранее и параллельно (не больше PREFETCH_QUEUE вперёд),
+        # а отправка идёт строго по порядку кандидатов
+        async def producer():
+            for event in candidates:
+                await queue.put(asyncio.create_task(prepare_event(bot_obj, event)))
+            await queue.put(None)
+
+        producer_task = asyncio.create_task(producer())
+        posted = 0
+        batch = []
+
+        def log_published(items: List[Dict]):
+            nonlocal posted
+            for p in items:
+                posted += 1
+                logger.info(f"✅ ({posted}) {p['event'].get('title','')[:50]}")
+
+        while True:
+            if stop is not None and stop.is_set():
+                logger.info("🛑 Остановка: оставшиеся ивенты опубликуем в следующий раз")
+                break
+            task = await queue.get()
+            if task is None:
+                break
+            prepared = await task
+            if not prepared or prepared["link"] in bot_obj.posted:
                 continue
 
-            photo_url = event.get("image_url")
-            # Если нет фото (например Google Forms или статья без обложки), то мы просто пропускаем
-            if not photo_url:
-                logger.info(f"🚫 Пропускаем ивент (нет обложки): {event.get('title')[:50]}")
+            if ALBUM_MODE and any(p["link"] == prepared["link"] for p in batch):
                 continue
 
-            try:
-                # 🔥 2. НАДЕЖНАЯ ОТПРАВКА: Скачиваем фото в буфер
-                session = await bot_obj.get_session()
-                async with session.get(photo_url, timeout=15) as resp:
-                    if resp.status == 200:
-                        photo_bytes = await resp.read()
-                        await bot_api.send_photo(
-                            chat_id=CHANNEL_ID,
-                            message_thread_id=MESSAGE_THREAD_ID,
-                            photo=photo_bytes,
-                            caption=text,
-                            parse_mode="HTML",
-                        )
-                    else:
-                        raise Exception("Bad HTTP status for image")
-            except Exception as img_e:
-                logger.warning(f"🚫 Не удалось скачать фото, пропускаем ивент. Ошибка: {img_e}")
+            # Проверка при отправке, а не при подготовке: дубль мог быть опубликован минуту назад в этом же цикле
+            event = prepared["event"]
+            same_cover = bot_obj.image_index.duplicate_of(prepared["phash"], event.get("event_date"), batch)
+            if same_cover:
+                logger.info(f"🖼️ Та же обложка уже у {same_cover}, пропускаем: {event.get('title', '')[:50]}")
+                bot_obj.image_index.suppressed += 1
+                if prepared["digest"]:
+                    bot_obj.rejected.add(prepared["link"], prepared["digest"], "duplicate_cover", event.get("event_date"))
                 continue
 
-            bot_obj.posted.add(norm_link)
-            save_posted(bot_obj.posted)
+            if ALBUM_MODE:
+                batch.append(prepared)
+                if len(batch) >= ALBUM_SIZE:
+                    log_published(await publish_album(bot_obj, batch))
+                    batch = []
+                continue
 
-            posted += 1
-            logger.info(f"✅ ({posted}) {event.get('title','')[:50]}")
+            if await publish_single(bot_obj, prepared):
+                log_published([prepared])
 
-            await asyncio.sleep(2)
+        # Уже подготовленный неполный альбом отправляем и при остановке — он готов целиком
+        if batch:
+            log_published(await publish_album(bot_obj, batch))
 
         logger.info(f"✅ Готово! Опубликовано новых: {posted}")
+        get_sender().report()
+        return posted
+
+    finally:
+        if producer_task and not producer_task.done():
+            producer_task.cancel()
+        while not queue.empty():
+            task = queue.get_nowait()
+            if task:
+                task.cancel()
+
+
+def digest_title(event: Dict) -> str:
+    # Та же зачистка заголовка, что в make_post, без сверки с описанием
+    title = remove_city_from_title((event.get("title") or "").strip())
+    title = strip_leading_datetime_from_title(title)
+    title = remove_dates_and_times(fix_glued_words(title))
+    title = re.sub(r"https?://\S+|www\.\S+|\b[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}(?:/\S*)?\b", "", title).strip()
+    return remove_city_and_hub_from_text(title).strip(" -–•.,:;|")
+
+
+def build_digest(events: List[Dict], days: int = DIGEST_DAYS, limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    """HTML-дайджест ивентов на days дней вперёд, по датам и городам; каждое сообщение не длиннее limit."""
+    import html
+
+    today = datetime.now().date()
+    start = today.isoformat()
+    end = datetime.fromordinal(today.toordinal() + days).date().isoformat()
+
+    rows, seen = [], set()
+    for event in events:
+        link = normalize_link(event.get("link", ""))
+        if not link or link in seen or not start <= (event.get("event_date") or "") <= end:
+            continue
+        # В дайджест попадает только то, что make_post пропустил бы в канал
+        if not make_post(dict(event)):
+            continue
+        seen.add(link)
+        location = event.get("location") or ""
+        if location in ("Онлайн", "Онлайн (Zoom)"):
+            place = "🌐 Онлайн"
+        else:
+            place = f"🏙 {location or 'Казахстан'}"
+        tm = re.search(r"\d{1,2}:\d{2}", event.get("date") or "")
+        time_str = tm.group(0) if tm else ""
+        title = html.escape(digest_title(event) or event.get("title", ""))
+        line = f"• {time_str + ' ' if time_str else ''}<a href='{link}'>{title}</a>"
+        rows.append((event["event_date"], place, time_str.zfill(5), line))
+
+    if not rows:
+        return []
+    rows.sort()
+
+    header = f"🗓 <b>Стартап-ивенты на {days} дн. вперёд</b>"
+    messages, current = [], [header]
+    cur_date = cur_place = None
+    for event_date, place, _, line in rows:
+        day_line = f"📅 <b>{format_date(datetime.fromisoformat(event_date))}</b>"
+        block = []
+        if event_date != cur_date:
+            block += ["", day_line, place]
+        elif place != cur_place:
+            block.append(place)
+        block.append(line)
+        if len("\n".join(current + block)) > limit:
+            messages.append("\n".join(current))
+            # Продолжение повторяет дату и город, чтобы сообщение читалось само по себе
+            current, block = [], [day_line, place, line]
+        current += block
+        cur_date, cur_place = event_date, place
+    messages.append("\n".join(current))
+    return messages
+
+
+async def send_digest(bot_obj: EventBot) -> bool:
+    """Дайджест по событиям, собранным при обходе. False — не отправлен, стоит повторить в следующий раз."""
+    from telegram.error import TimedOut
+
+    messages = build_digest(bot_obj.upcoming.events())
+    if not messages:
+        logger.info("🗓 Ближайших ивентов нет — дайджест не отправляем")
+        return True
+
+    first = None
+    try:
+        for text in messages:
+            msg = await get_sender().send(
+                get_bot_api(), "send_message",
+                chat_id=CHANNEL_ID,
+                message_thread_id=MESSAGE_THREAD_ID,
+                text=text,
+                parse_mode="HTML",
+                disable_web_page_preview=True,
+            )
+            if first is None:
+                first = msg
+    except TimedOut as e:
+        # Сообщение могло уйти — второй дайджест за день хуже пропущенного закрепа
+        logger.warning(f"⌛ Таймаут отправки дайджеста, считаем отправленным. Ошибка: {e}")
+        return True
+    except Exception as e:
+        logger.error(f"🗓 Дайджест не отправился, повторим в следующий запуск: {e}")
+        return False
+    logger.info(f"🗓 Дайджест отправлен: сообщений {len(messages)}")
+
+    if DIGEST_PIN and first is not None:
+        try:
+            await get_bot_api().pin_chat_message(chat_id=CHANNEL_ID, message_id=first.message_id, disable_notification=True)
+        except Exception as e:
+            logger.warning(f"📌 Не удалось закрепить дайджест: {e}")
+    return True
+
+
+async def maybe_send_digest(bot_obj: EventBot):
+    # Дайджест идёт из обычного запуска, а не из отдельного cron: отметка в state/ гарантирует один в день,
+    # даже если запуски опаздывают или идут пачкой
+    if DIGEST_HOUR_UTC is None:
+        return
+    now = datetime.now(timezone.utc)
+    today = now.date().isoformat()
+    if now.hour < DIGEST_HOUR_UTC or load_json(DIGEST_MARKER_FILE, {}).get("date") == today:
+        return
+    logger.info(f"🗓 Дайджест на {DIGEST_DAYS} дн. за {today}...")
+    if await send_digest(bot_obj):
+        save_json(DIGEST_MARKER_FILE, {"date": today})
+
+
+async def run_digest():
+    """Обход источников и один дайджест на DIGEST_DAYS дней вместо поштучных постов."""
+    logger.info(f"🗓 Дайджест на {DIGEST_DAYS} дн....")
+    if not BOT_TOKEN and not HTTP_FIXTURES:
+        logger.error("❌ BOT_TOKEN не найден!")
+        return
+
+    bot_obj = EventBot()
+    try:
+        bot_obj.upcoming.record(await bot_obj.get_all_events())
+        if await send_digest(bot_obj):
+            save_json(DIGEST_MARKER_FILE, {"date": datetime.now(timezone.utc).date().isoformat()})
+    finally:
+        await bot_obj.close()
+
 
+async def main():
+    logger.info("🚀 Старт...")
+    if not BOT_TOKEN and not HTTP_FIXTURES:
+        logger.error("❌ BOT_TOKEN не найден!")
+        return
+
+    bot_obj = EventBot()
+
+    try:
+        await run_cycle(bot_obj)
+        await maybe_send_digest(bot_obj)
+    finally:
+        await bot_obj.close()
+
+
+async def run_daemon():
+    """Один тёплый процесс: сессия, соединения и состояние живут между циклами; SIGTERM дожидается текущего поста."""
+    logger.info(f"🚀 Старт в режиме демона (каждые {DAEMON_INTERVAL_MIN:g} мин)...")
+    if not BOT_TOKEN and not HTTP_FIXTURES:
+        logger.error("❌ BOT_TOKEN не найден!")
+        return
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: остаётся KeyboardInterrupt
+
+    bot_obj = EventBot()
+
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                await run_cycle(bot_obj, stop)
+                if not stop.is_set():
+                    await maybe_send_digest(bot_obj)
+            except Exception as e:
+                logger.error(f"❌ Ошибка цикла: {e}")
+            bot_obj.save_state()
+
+            delay = DAEMON_INTERVAL_MIN * 60 + random.uniform(-DAEMON_JITTER_SEC, DAEMON_JITTER_SEC)
+            delay = max(0.0, delay - (time.monotonic() - started))
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
     finally:
+        logger.info("👋 Демон остановлен")
         await bot_obj.close()
 
+def run_with_temp_state(copy_from: Optional[Path] = None) -> int:
+    """Перезапуск того же скрипта с чистым временным STATE_DIR; папка удаляется после выхода."""
+    import shutil
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory(prefix="bot-state-") as tmp:
+        if copy_from is not None and copy_from.is_dir():
+            shutil.copytree(copy_from, tmp, dirs_exist_ok=True)
+        # Пути состояния — константы модуля, поэтому временная папка передаётся новому процессу через окружение
+        env = dict(os.environ, STATE_DIR=tmp, BOT_TEMP_STATE="1")
+        return subprocess.call([sys.executable, os.path.abspath(sys.argv[0]), *sys.argv[1:]], env=env)
+
+def fixtures_entry():
+    """Точка входа с HTTP_FIXTURES: проверка значения и временное состояние, если STATE_DIR не задан.
+    Прогон по фикстурам воспроизводим и не трогает боевой state/; при перезапуске процесс завершается здесь."""
+    value = os.getenv("HTTP_FIXTURES", "")
+    if value and not HTTP_FIXTURES:
+        logger.warning(f"⚠️ HTTP_FIXTURES={value!r} не распознан (ждём {' или '.join(HTTP_FIXTURES_MODES)}) — обычный запуск")
+    if HTTP_FIXTURES and not os.getenv("STATE_DIR"):
+        sys.exit(run_with_temp_state())
+
+def startup_report():
+    """Разбивка холодного старта: модуль, тяжёлые зависимости, состояние и регулярки (python bot.py --startup-report)."""
+    # EventBot() может свернуть журнал, пересобрать Bloom-фильтр или создать events.db —
+    # загрузчики замеряются на копии состояния, боевой state/ не меняется
+    if not os.getenv("BOT_TEMP_STATE"):
+        sys.exit(run_with_temp_state(copy_from=STATE_DIR))
+
+    import importlib
+
+    rows = [("import bot.py (без зависимостей)", _MODULE_LOADED - _MODULE_STARTED)]
+    for name in ("aiohttp", "bs4", "telegram"):
+        started = time.perf_counter()
+        importlib.import_module(name)
+        rows.append((f"import {name}", time.perf_counter() - started))
+
+    started = time.perf_counter()
+    EventBot()
+    rows.append(("EventBot(): копия состояния и кэшей", time.perf_counter() - started))
+
+    started = time.perf_counter()
+    city_patterns()
+    glue_re()
+    rows.append(("регулярки городов", time.perf_counter() - started))
+
+    for name, seconds in rows:
+        print(f"{name:<36}{seconds * 1000:9.1f} мс")
+    print(f"{'итого':<36}{sum(s for _, s in rows) * 1000:9.1f} мс")
+    print("Подробно по модулям: python -X importtime bot.py --startup-report")
+
+def crop_compare(folder: str):
+    """Сверка быстрой обрезки (полосы + OCR спорных) с OCR всей афиши (python bot.py --crop-compare DIR)."""
+    if not has_ocr():
+        print("Для сравнения нужен pytesseract и установленный tesseract")
+        return
+
+    def fmt(box):
+        return "—" if box is None else f"{box[0]:.2f}–{box[1]:.2f}"
+
+    files = sorted(p for p in Path(folder).iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp"))
+    same, ocr_time, fast_time = 0, 0.0, 0.0
+    for path in files:
+        data = path.read_bytes()
+        started = time.perf_counter()
+        ocr = ocr_crop_box(data)
+        ocr_time += time.perf_counter() - started
+        started = time.perf_counter()
+        fast = smart_crop_box(data)
+        fast_time += time.perf_counter() - started
+        # Полосы и рамки слов расходятся на несколько пикселей — сравниваем с допуском 2% высоты
+        ok = (ocr is None and fast is None) or (
+            ocr is not None and fast is not None and all(abs(a - b) <= 0.02 for a, b in zip(ocr, fast))
+        )
+        same += ok
+        print(f"{'✅' if ok else '❌'} {path.name:<40} OCR {fmt(ocr):<11} быстро {fmt(fast)}")
+
+    if files:
+        print(f"Совпало: {same}/{len(files)}; OCR всей афиши {ocr_time:.1f} с, быстрый путь {fast_time:.1f} с")
+
+_MODULE_LOADED = time.perf_counter()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    fixtures_entry()
+    if "--startup-report" in sys.argv[1:]:
+        startup_report()
+    elif "--daemon" in sys.argv[1:]:
+        asyncio.run(run_daemon())
+    elif "--digest" in sys.argv[1:]:
+        asyncio.run(run_digest())
+    elif "--crop-compare" in sys.argv[1:]:
+        args = sys.argv[sys.argv.index("--crop-compare") + 1:]
+        crop_compare(args[0] if args else ".")
+    else:
+        asyncio.run(main())
@@ -1,6 +1,10 @@
 import asyncio
+import json
 import logging
+import os
+from collections import OrderedDict
 from datetime import datetime, time
+from pathlib import Path
 from typing import List, Dict
 import aiohttp
 from bs4 import BeautifulSoup
@@ -11,6 +15,8 @@ from telegram.ext import (
     ContextTypes,
 )
 
+from telegram_sender import TelegramSender
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -26,6 +32,12 @@ CHANNEL_ID = "@startup_events_kz"
 MORNING_TIME = time(hour=4, minute=0)   # 09:00 Алматы
 EVENING_TIME = time(hour=13, minute=0)  # 18:00 Алматы
 #hour=18, #23:00
+
+# Память об опубликованном: сколько хранить и как часто сбрасывать на диск
+POSTED_EVENTS_FILE = Path('state') / 'manual_posted.json'
+POSTED_EVENTS_LIMIT = 200
+POSTED_EVENTS_SAVE_EVERY = 10      # записей между сохранениями
+POSTED_EVENTS_SAVE_INTERVAL = 600  # секунд, периодический сброс из job_queue
 # ================================================
 
 # Все сайты для парсинга
@@ -81,6 +93,60 @@ TELEGRAM_CHANNELS = [
 ]
 
 
+class RecentSet:
+    """Множество с порядком добавления: при переполнении вытесняются самые старые записи"""
+    
+    def __init__(self, capacity: int, path: Path):
+        self.capacity = capacity
+        self.path = path
+        self._items = OrderedDict()
+        self._unsaved = 0
+        self.load()
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+    
+    def __len__(self) -> int:
+        return len(self._items)
+    
+    def add(self, key: str):
+        if key in self._items:
+            self._items.move_to_end(key)
+        else:
+            self._items[key] = None
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+        self._unsaved += 1
+        if self._unsaved >= POSTED_EVENTS_SAVE_EVERY:
+            self.save()
+    
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                keys = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Ошибка чтения {self.path}: {e}")
+            return
+        # В файле ключи лежат от старых к новым — порядок восстанавливается как был
+        for key in keys[-self.capacity:]:
+            self._items[key] = None
+    
+    def save(self):
+        if not self._unsaved:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix('.json.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(list(self._items), f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._unsaved = 0
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {self.path}: {e}")
+
+
 class UniversalParser:
     """Универсальный парсер для всех источников"""
     
@@ -89,7 +155,7 @@ class UniversalParser:
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         self.session = None
-        self.posted_events = set()
+        self.posted_events = RecentSet(POSTED_EVENTS_LIMIT, POSTED_EVENTS_FILE)
         
         # Ключевые слова для поиска событий
         self.event_keywords = [
@@ -599,6 +665,7 @@ class UniversalParser:
 
 
 parser = UniversalParser()
+sender = TelegramSender()
 
 
 async def post_to_channel(context: ContextTypes.DEFAULT_TYPE):
@@ -628,7 +695,8 @@ async def post_to_channel(context: ContextTypes.DEFAULT_TYPE):
             try:
                 # Если есть изображение - отправляем с фото
                 if event.get('image_url'):
-                    await context.bot.send_photo(
+                    await sender.send(
+                        context.bot, 'send_photo',
                         chat_id=CHANNEL_ID,
                         photo=event['image_url'],
                         caption=caption,
@@ -636,7 +704,8 @@ async def post_to_channel(context: ContextTypes.DEFAULT_TYPE):
                     )
                 else:
                     # Если нет изображения - просто текст
-                    await context.bot.send_message(
+                    await sender.send(
+                        context.bot, 'send_message',
                         chat_id=CHANNEL_ID,
                         text=caption,
                         parse_mode='HTML',
@@ -647,13 +716,12 @@ async def post_to_channel(context: ContextTypes.DEFAULT_TYPE):
                 posted_count += 1
                 logger.info(f"✅ Опубликовано ({posted_count}): {event['title'][:40]}...")
                 
-                await asyncio.sleep(3)  # Задержка между постами
-                
             except Exception as e:
                 logger.error(f"❌ Ошибка публикации: {e}")
                 # Если не получилось с картинкой, пробуем без неё
                 try:
-                    await context.bot.send_message(
+                    await sender.send(
+                        context.bot, 'send_message',
                         chat_id=CHANNEL_ID,
                         text=caption,
                         parse_mode='HTML',
@@ -664,8 +732,8 @@ async def post_to_channel(context: ContextTypes.DEFAULT_TYPE):
                 except:
                     pass
         
-        if len(parser.posted_events) > 200:
-            parser.posted_events = set(list(parser.posted_events)[-100:])
+        parser.posted_events.save()
+        sender.report()
         
         logger.info(f"✅ Публикация завершена! Опубликовано: {posted_count} событий")
         
@@ -673,6 +741,11 @@ async def post_to_channel(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"❌ Ошибка в post_to_channel: {e}")
 
 
+async def save_posted_events(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое сохранение опубликованных событий на диск"""
+    parser.posted_events.save()
+
+
 async def manual_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ручная публикация (команда /post)"""
     await update.message.reply_text("🔄 Начинаю публикацию событий...")
@@ -751,6 +824,12 @@ def main():
                 name='evening_post'
             )
             
+            application.job_queue.run_repeating(
+                save_posted_events,
+                interval=POSTED_EVENTS_SAVE_INTERVAL,
+                name='save_posted_events'
+            )
+            
             logger.info("🚀 Универсальный бот запущен!")
             logger.info(f"📢 Канал: {CHANNEL_ID}")
             logger.info(f"🌐 Парсинг {len(URLS)} сайтов + {len(TELEGRAM_CHANNELS)} Telegram каналов")
@@ -768,4 +847,5 @@ if __name__ == '__main__':
     try:
         main()
     finally:
+        parser.posted_events.save()
         asyncio.run(parser.close())
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""Отправка в Telegram с учётом лимитов — общая для bot.py и bot_manual.py."""
+import os
+import math
+import time
+import random
+import asyncio
+import logging
+from typing import List, Dict
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений/с на бота и ~20 в минуту в одну группу/канал
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_PER_MIN = float(os.getenv("TG_CHAT_PER_MIN", "20"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_SEND_RETRIES = int(os.getenv("TG_SEND_RETRIES", "3"))
+# Пауза перед повтором после сетевой ошибки — та же, что у повторов HTTP в bot.py
+TG_RETRY_BACKOFF = float(os.getenv("FETCH_BACKOFF", "0.5"))
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity впрок. acquire() ждёт ровно до появления токена."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        # После RetryAfter Telegram ничего не примет до конца паузы; после неё — один токен, без накопленного запаса
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 1.0
+        self.updated = self.blocked_until
+
+    async def acquire(self) -> float:
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+
+def retry_after_seconds(value) -> float:
+    # PTB отдаёт retry_after числом или timedelta — в зависимости от версии
+    return float(value.total_seconds() if hasattr(value, "total_seconds") else value)
+
+
+class TelegramSender:
+    """Отправка в Telegram через токен-бакеты (на чат и общий), с ожиданием RetryAfter и метриками задержек."""
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_per_min: float = TG_CHAT_PER_MIN,
+                 chat_burst: int = TG_CHAT_BURST, retries: int = TG_SEND_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_per_min / 60
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.chats: Dict[str, TokenBucket] = {}
+        self.latencies: List[float] = []
+        self.throttled = 0.0
+        self.retry_after_hits = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        if key not in self.chats:
+            self.chats[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chats[key]
+
+    async def send(self, bot, method: str, **kwargs):
+        """bot.<method>(**kwargs) с учётом лимитов. RetryAfter и сетевые сбои повторяются, таймаут — нет:
+        сообщение могло уйти, а дубль в канале хуже пропуска."""
+        from telegram.error import NetworkError, RetryAfter, TimedOut
+
+        chat = self._chat_bucket(kwargs.get("chat_id"))
+        for attempt in range(self.retries + 1):
+            self.throttled += await chat.acquire()
+            self.throttled += await self.global_bucket.acquire()
+            started = time.perf_counter()
+            try:
+                result = await getattr(bot, method)(**kwargs)
+            except RetryAfter as e:
+                if attempt >= self.retries:
+                    raise
+                delay = retry_after_seconds(e.retry_after) + random.uniform(0, 0.5)
+                self.retry_after_hits += 1
+                chat.pause(delay)
+                logger.warning(f"🐢 Telegram просит подождать {delay:.1f} с (попытка {attempt + 1})")
+            except TimedOut:
+                raise
+            except NetworkError as e:
+                if attempt >= self.retries:
+                    raise
+                delay = TG_RETRY_BACKOFF * (2 ** attempt) + random.uniform(0, TG_RETRY_BACKOFF)
+                logger.warning(f"🔁 Сетевая ошибка Telegram: {e}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+            else:
+                self.latencies.append(time.perf_counter() - started)
+                return result
+
+    def report(self):
+        if not self.latencies:
+            return
+        lat = sorted(self.latencies)
+        p50 = lat[len(lat) // 2]
+        p95 = lat[min(len(lat) - 1, math.ceil(len(lat) * 0.95) - 1)]
+        logger.info(
+            f"📨 Отправлено: {len(lat)}, задержка p50 {p50 * 1000:.0f} мс / p95 {p95 * 1000:.0f} мс / "
+            f"max {lat[-1] * 1000:.0f} мс, ожидание лимитов {self.throttled:.1f} с, RetryAfter: {self.retry_after_hits}"
+        )
+        # В режиме демона отчёт — за цикл, а не с момента запуска
+        self.latencies, self.throttled, self.retry_after_hits = [], 0.0, 0
@@ -1,9 +1,11 @@
 import sys
 import asyncio
+from pathlib import Path
 
-sys.path.append("/Users/diastursynbek/Downloads/PROga/PYT PROJECT/Event_bot")
+# Работает из любой папки; без сети: HTTP_FIXTURES=replay python test_parse.py (после прогона с HTTP_FIXTURES=record)
+sys.path.insert(0, str(Path(__file__).resolve().parent))
 
-from bot import EventBot, make_post
+from bot import EventBot, fixtures_entry, make_post
 
 async def main():
     bot_obj = EventBot()
@@ -36,4 +38,5 @@ async def main():
     await bot_obj.close()
 
 if __name__ == "__main__":
+    fixtures_entry()
     asyncio.run(main())